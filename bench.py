@@ -0,0 +1,362 @@
+"""
+Benchmarks for wbuild.py on synthetic documents.
+
+Times each stage of a build (tag extraction, doc tree, html, footer) at
+several document sizes, writes the results to JSON and optionally compares
+them against a stored baseline:
+
+    python3 bench.py --nodes 1000,10000,100000 -o bench.json
+    python3 bench.py --baseline bench.json --threshold 1.25
+
+Startup (import time and a CLI build of a small page) is measured apart,
+and fails if `import wbuild` takes longer than the budget (milliseconds)
+or imports a module that should only be imported when used:
+
+    python3 bench.py --startup --startup-budget 20
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+
+from wbuild import (
+    scr_dir,
+    extract_top_level_tags,
+    build_doc_dict,
+    html_from_dict,
+    create_and_append_footer,
+)
+
+BENCH_VERSION = 1
+# milliseconds `import wbuild` may take, see bench_startup
+STARTUP_BUDGET_MS = 20
+# modules wbuild only imports where they are used
+LAZY_MODULES = ("argparse", "glob", "gzip", "hashlib", "html", "tracemalloc", "concurrent.futures", "http.server")
+STAGES = ("extract_top_level_tags", "build_doc_dict", "html_from_dict", "create_and_append_footer")
+
+_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+    "exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+_LIST_INDICATORS = ("*", "#", "-")
+
+
+def generate_doc(
+        nodes: int=1000,
+        columns: int=0,
+        paragraph_words: int=60,
+        link_density: float=0.03,
+        showarg_density: float=0.01,
+        toc_density: float=0.0,
+        list_depth: int=3,
+        list_items: int=8,
+        code_lines: int=10,
+        seed: int=0) -> str:
+    """
+    Generate a wbuild document of roughly `nodes` doc items.
+    Params:
+    - nodes: approximate number of items (sections, columns, headers, ...) to generate
+    - columns: columns per section, 0 for none
+    - paragraph_words: words per text paragraph
+    - link_density: chance per word of a \\link (half to a uid, half external)
+    - showarg_density: chance per word of a \\showarg of an earlier header
+    - toc_density: chance per section of a \\tableofcontents paragraph
+    - list_depth: deepest list level
+    - list_items: items per list
+    - code_lines: lines per code block
+    - seed: random seed, equal params and seed give the same document
+    Returns: document text
+    """
+    if nodes < 1:
+        raise ValueError(f"nodes must be positive, got {nodes}")
+    if list_depth < 1 or list_depth > 3:
+        raise ValueError(f"list_depth must be between 1 and 3, got {list_depth}")
+    rng = random.Random(seed)
+    uids = []
+
+    def words(n):
+        out = []
+        for _ in range(n):
+            word = rng.choice(_WORDS)
+            roll = rng.random()
+            if roll < link_density:
+                if uids and roll < link_density / 2:
+                    word = f"\\link{{#{rng.choice(uids)}}}{{{word}}}"
+                else:
+                    word = f"\\link{{https://example.com/{word}}}{{{word}}}"
+            elif uids and roll < link_density + showarg_density:
+                word = f"\\showarg{{{rng.choice(uids)}}}{{label}}"
+            out.append(word)
+        return " ".join(out)
+
+    def list_block():
+        lines = []
+        level = 1
+        for _ in range(list_items):
+            level = max(1, min(list_depth, level + rng.choice((-1, 0, 1))))
+            lines.append(rng.choice(_LIST_INDICATORS) * level + ") " + words(8))
+        return "[list][\n" + "\n".join(lines) + "\n]"
+
+    def code_block():
+        lines = [f"def f{i}(x):    return x * {i}" for i in range(code_lines)]
+        return "[code][\n" + "\n".join(lines) + "\n]"
+
+    blocks = []
+    count = 1  # root section
+    sec = 0
+    while count < nodes:
+        uid = f"s{sec}"
+        blocks.append(f"[section]\n[header][label=Section {sec}, uid={uid}]")
+        count += 2
+        if rng.random() < toc_density:
+            blocks.append("\\tableofcontents")
+            count += 1
+        for col in range(max(columns, 1)):
+            if columns:
+                blocks.append("[column]")
+                count += 1
+            blocks.append(f"[subheader][numbered=True, label=Part {sec}.{col}, uid={uid}-{col}]")
+            blocks.append(words(paragraph_words))
+            blocks.append(list_block())
+            blocks.append(words(paragraph_words))
+            blocks.append(code_block())
+            blocks.append(f"[bq][italicize=True]\n{words(paragraph_words // 2)}")
+            count += 6
+        uids.append(uid)
+        sec += 1
+    return "\n\n".join(blocks) + "\n"
+
+
+def count_nodes(doc) -> int:
+    """
+    Returns: number of items in the doc tree `doc`, including `doc`
+    """
+    total = 0
+    stack = [doc]
+    while stack:
+        item = stack.pop()
+        total += 1
+        if isinstance(item.data, list):
+            stack.extend(item.data)
+    return total
+
+
+def _best_time(fn: Callable[[], Any], repeat: int) -> tuple[float, Any]:
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_stages(text: str, footer_path: str, repeat: int=3) -> dict:
+    """
+    Time each build stage on `text`, keeping the best of `repeat` runs.
+    Params:
+    - text: wbuild document
+    - footer_path: footer file for the `create_and_append_footer` stage
+    - repeat: runs per stage
+    Returns: dict with 'nodes', 'bytes' and 'stages' (stage -> seconds)
+    """
+    stages = {}
+    stages["extract_top_level_tags"], _ = _best_time(lambda: extract_top_level_tags(text), repeat)
+    stages["build_doc_dict"], doc = _best_time(lambda: build_doc_dict(text), repeat)
+    stages["html_from_dict"], page = _best_time(lambda: html_from_dict(doc, mode="light"), repeat)
+    stages["create_and_append_footer"], _ = _best_time(
+        lambda: create_and_append_footer(footer_path, page), repeat)
+    return {"nodes": count_nodes(doc), "bytes": len(text.encode()), "stages": stages}
+
+
+def run(sizes: list[int], footer_path: str, repeat: int=3, log=True, **gen_params) -> dict:
+    """
+    Benchmark generated documents of each size in `sizes`.
+    Params:
+    - sizes: requested node counts
+    - footer_path: footer file for the footer stage
+    - repeat: runs per stage
+    - log: print a line per size
+    - gen_params: passed on to `generate_doc`
+    Returns: JSON-serializable report
+    """
+    results = []
+    for size in sizes:
+        text = generate_doc(size, **gen_params)
+        res = bench_stages(text, footer_path, repeat)
+        res["size"] = size
+        results.append(res)
+        if log:
+            times = "  ".join(f"{st}={res['stages'][st] * 1000:.1f}ms" for st in STAGES)
+            print(f"{res['nodes']:>8} nodes  {times}")
+    return {
+        "version": BENCH_VERSION,
+        "python": platform.python_version(),
+        "params": dict(gen_params, repeat=repeat),
+        "results": results,
+    }
+
+
+_IMPORT_LINE = re.compile(r"^import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)$", re.M)
+
+
+def _import_times(module: str) -> list[tuple[str, int]]:
+    # (name, cumulative us) of `module` and the modules it imports first, from -X importtime
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], 
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    lines = [
+        (name, int(cumulative), len(indent) // 2) 
+        for _, cumulative, indent, name in _IMPORT_LINE.findall(proc.stderr)
+    ]
+    # a module's imports are listed right before it, after the previous top-level import
+    end = next(i for i, (name, _, depth) in enumerate(lines) if name == module and depth == 0)
+    start = end
+    while start > 0 and lines[start - 1][2] > 0:
+        start -= 1
+    return [(name, us) for name, us, depth in lines[start:end + 1] if depth <= 1]
+
+
+def bench_startup(runs: int=10, n_slowest: int=8) -> dict:
+    """
+    Time the start of wbuild, keeping the best of `runs` runs: `import
+    wbuild` as reported by `python -X importtime`, and a CLI build of a
+    small page (run as a script and as a module) against a bare interpreter
+    start.
+    Returns: dict with 'import', 'cli', 'cli_module' and 'python' (seconds),
+    'slowest' (modules imported by wbuild with their cumulative seconds) and
+    'eager' (modules of `LAZY_MODULES` imported by `import wbuild`)
+    """
+    best_import = float("inf")
+    for _ in range(runs):
+        times = _import_times("wbuild")
+        best_import = min(best_import, times[-1][1] / 1e6)
+    imported = {name for name, _ in times}
+    slowest = sorted(((name, us / 1e6) for name, us in times[:-1]), key=lambda item: -item[1])
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        page = os.path.join(tmp, "page.txt")
+        with open(page, "w") as f:
+            f.write(generate_doc(50))
+        args = ["-i", page, "-o", os.path.join(tmp, "page.html")]
+        cli, _ = _best_time(lambda: subprocess.run(
+            [sys.executable, os.path.join(here, "wbuild.py"), *args], check=True, stdout=subprocess.DEVNULL), runs)
+        # unlike a script, a module is loaded from its cached bytecode
+        cli_module, _ = _best_time(lambda: subprocess.run(
+            [sys.executable, "-m", "wbuild", *args], cwd=here, check=True, stdout=subprocess.DEVNULL), runs)
+    python, _ = _best_time(lambda: subprocess.run([sys.executable, "-c", "pass"], check=True), runs)
+    return {
+        "import": best_import,
+        "cli": cli,
+        "cli_module": cli_module,
+        "python": python,
+        "slowest": slowest[:n_slowest],
+        "eager": [name for name in LAZY_MODULES if name in imported],
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float=1.25, min_time: float=0.001) -> list[str]:
+    """
+    Compare `report` against `baseline`, matching results by requested size.
+    Params:
+    - threshold: allowed slowdown factor per stage
+    - min_time: stages faster than this (seconds) in the baseline are not compared
+    Returns: description of each regression, empty if none
+    """
+    if baseline.get("version") != report.get("version"):
+        raise ValueError(f"Baseline version {baseline.get('version')} does not match {report.get('version')}")
+    base_by_size = {res["size"]: res for res in baseline["results"]}
+    regressions = []
+    for res in report["results"]:
+        base = base_by_size.get(res["size"])
+        if base is None:
+            continue
+        for stage in STAGES:
+            old, new = base["stages"].get(stage), res["stages"][stage]
+            if old is None or old < min_time:
+                continue
+            if new > old * threshold:
+                regressions.append(
+                    f"{stage} at {res['size']} nodes: {old * 1000:.1f}ms -> {new * 1000:.1f}ms ({new / old:.2f}x)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark wbuild stages on generated documents")
+    parser.add_argument("--nodes", type=str, default="1000,10000,100000", help="Comma separated document sizes (items)")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="Runs per stage, the best is kept")
+    parser.add_argument("--columns", type=int, default=0, help="Columns per section")
+    parser.add_argument("--words", type=int, default=60, help="Words per paragraph")
+    parser.add_argument("--links", type=float, default=0.03, help="Link density (per word)")
+    parser.add_argument("--showargs", type=float, default=0.01, help="\\showarg density (per word)")
+    parser.add_argument("--tocs", type=float, default=0.0, help="\\tableofcontents density (per section)")
+    parser.add_argument("--list-depth", type=int, default=3, help="Deepest list level (1-3)")
+    parser.add_argument("--list-items", type=int, default=8, help="Items per list")
+    parser.add_argument("--code-lines", type=int, default=10, help="Lines per code block")
+    parser.add_argument("--seed", type=int, default=0, help="Generator seed")
+    parser.add_argument("--footer", "-f", type=str, default=f"{scr_dir}/footer.txt", help="Footer file for the footer stage")
+    parser.add_argument("--out", "-o", type=str, default="", help="Write the report as JSON")
+    parser.add_argument("--baseline", "-b", type=str, default="", help="Baseline JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Allowed slowdown factor against the baseline")
+    parser.add_argument("--emit", type=int, default=None, help="Only print a generated document of this size")
+    parser.add_argument("--startup", action="store_true", help="Only measure startup, see bench_startup")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET_MS, 
+        help="Milliseconds import wbuild may take")
+    args = parser.parse_args()
+
+    if args.startup:
+        res = bench_startup(args.repeat * 3)
+        print(f"import wbuild {res['import'] * 1000:.1f}ms (budget {args.startup_budget:g}ms)")
+        print(f"CLI build of a small page {res['cli'] * 1000:.1f}ms, {res['cli_module'] * 1000:.1f}ms with -m wbuild "
+            + f"(starting python {res['python'] * 1000:.1f}ms)")
+        print("Slowest imports:")
+        for name, seconds in res["slowest"]:
+            print(f"  {seconds * 1000:6.1f}ms  {name}")
+        failed = False
+        if res["eager"]:
+            print(f"REGRESSION imported by import wbuild: {', '.join(res['eager'])}")
+            failed = True
+        if res["import"] * 1000 > args.startup_budget:
+            print("REGRESSION import wbuild over budget")
+            failed = True
+        sys.exit(1 if failed else 0)
+
+    gen_params = {
+        "columns": args.columns,
+        "paragraph_words": args.words,
+        "link_density": args.links,
+        "showarg_density": args.showargs,
+        "toc_density": args.tocs,
+        "list_depth": args.list_depth,
+        "list_items": args.list_items,
+        "code_lines": args.code_lines,
+        "seed": args.seed,
+    }
+    if args.emit is not None:
+        sys.stdout.write(generate_doc(args.emit, **gen_params))
+        sys.exit(0)
+
+    sizes = [int(size) for size in args.nodes.split(",") if size.strip()]
+    report = run(sizes, args.footer, args.repeat, **gen_params)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {os.path.abspath(args.out)}")
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for reg in regressions:
+            print(f"REGRESSION {reg}")
+        if regressions:
+            sys.exit(1)
+        print(f"No stage slower than {args.threshold}x the baseline")
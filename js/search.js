@@ -0,0 +1,63 @@
+// Search box of a site built with --search: the index is fetched on first
+// use, results need every word of the query (the last one as a prefix)
+const searchBox = document.querySelector('div.search');
+const searchInput = searchBox.querySelector('input');
+const searchResults = searchBox.querySelector('ul');
+const searchIndexUrl = new URL(searchBox.getAttribute('data-index'), document.baseURI);
+let searchIndex = null;
+
+function loadSearchIndex() {
+    if (searchIndex == null) {
+        searchIndex = fetch(searchIndexUrl).then(res => res.json());
+    }
+    return searchIndex;
+}
+
+function addSections(ids, gaps) {
+    // section indices of a token are stored as differences
+    let id = 0;
+    for (const gap of gaps) {
+        id += gap;
+        ids.add(id);
+    }
+}
+
+function searchSections(index, query) {
+    const words = query.toLowerCase().match(/[\p{L}\p{N}_]{2,}/gu) || [];
+    let found = null;
+    words.forEach((word, i) => {
+        const ids = new Set();
+        if (i == words.length - 1) {
+            for (const token in index.tokens) {
+                if (token.startsWith(word)) addSections(ids, index.tokens[token]);
+            }
+        } else {
+            addSections(ids, index.tokens[word] || []);
+        }
+        found = found == null ? ids : new Set([...found].filter(id => ids.has(id)));
+    });
+    return found == null ? [] : [...found];
+}
+
+function showSearchResults(index, ids) {
+    searchResults.replaceChildren();
+    for (const id of ids.slice(0, 20)) {
+        const [page, anchor, heading] = index.sections[id];
+        const [url, title] = index.pages[page];
+        const link = document.createElement('a');
+        link.className = 'link';
+        link.href = new URL(url + (anchor ? '#' + anchor : ''), searchIndexUrl).href;
+        link.textContent = heading && heading != title ? title + ' › ' + heading : title;
+        const item = document.createElement('li');
+        item.appendChild(link);
+        searchResults.appendChild(item);
+    }
+}
+
+searchInput.addEventListener('focus', loadSearchIndex);
+searchInput.addEventListener('input', () => {
+    const query = searchInput.value;
+    loadSearchIndex().then(index => {
+        if (searchInput.value == query) showSearchResults(index, searchSections(index, query));
+    });
+});
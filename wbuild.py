@@ -1,10 +1,21 @@
 import re
 import time
-import html as ht
+import itertools
 import os
-from typing import Optional, Literal, Any
-import argparse
-from bs4 import BeautifulSoup
+from typing import Optional, Literal, Any, Iterable, Iterator, Callable, TYPE_CHECKING
+import json
+import sys
+import threading
+import contextlib
+import contextvars
+import struct
+import posixpath
+from collections import Counter, OrderedDict
+# only imported where needed, as a build of a page doesn't use them (see
+# `bench.py --startup`): argparse, glob, gzip, hashlib, tracemalloc,
+# concurrent.futures and http.server
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
 
 scr_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -115,39 +126,218 @@ TYPES = [
         }
     }
 ]
-def build_doc_dict(txt: str) -> dict:
+
+def _to_bool(val: str) -> bool:
+    low = val.strip().lower()
+    if low in ("true", "1", "yes"):
+        return True
+    if low in ("false", "0", "no"):
+        return False
+    raise ValueError(f"Expected True or False, got {val!r}")
+
+def _coercer(default: Any) -> Callable[[str], Any]:
+    """
+    Returns: function converting an argument string to the type of `default`
+    """
+    if isinstance(default, bool):
+        return _to_bool
+    if isinstance(default, int):
+        return int
+    if isinstance(default, float):
+        return float
+    return str.strip
+
+# type -> arg -> (default, coercer), compiled from TYPES
+SCHEMA = {
+    item["type"]: {arg: (val, _coercer(val)) for arg, val in item["args"].items()}
+    for item in TYPES
+}
+
+# type -> default args, shared by all items until they set an arg
+_TYPE_ARGS = {item["type"]: item["args"] for item in TYPES}
+
+# ids of items created outside of build_doc_dict
+_loose_ids = itertools.count(1 << 48)
+
+# first id of footer items, keeps them apart from page ids on the same page
+FOOTER_FIRST_ID = 1 << 32
+
+class DocNode:
+    """
+    Item of a document: a section, column, header, text, etc.
+    - type: str, one of the types in `TYPES`
+    - id: int, unique within the document (str for items made while rendering)
+    - args: dict[str, Any], shared with the type's defaults until `set_arg`
+    is called, so never write to it directly
+    - data: list of DocNode for sections and columns, str otherwise
+    - inline: inline ASTs of the text fields (see `parse_item_inline`)
+    """
+    __slots__ = ("type", "id", "args", "data", "inline")
+
+    def __init__(self, type: str, ident: int | str, data: list | str="", args: Optional[dict[str, Any]]=None):
+        self.type = type
+        self.id = ident
+        self.args = _TYPE_ARGS[type] if args is None else args
+        self.data = data
+        self.inline = None
+
+    def set_arg(self, key: str, val: Any) -> None:
+        if self.args is _TYPE_ARGS[self.type]:
+            self.args = dict(self.args)
+        self.args[key] = val
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Returns: the item as a doc dict ('type', 'id', 'args', 'data'),
+        recursively for sections and columns
+        """
+        return {
+            "type": self.type,
+            "id": self.id,
+            "args": dict(self.args),
+            "data": [part.to_dict() for part in self.data] if isinstance(self.data, list) else self.data,
+        }
+
+    def __repr__(self) -> str:
+        return f"DocNode({self.type!r}, {self.id})"
+
+_HEADING_LEVELS = {"header": 1, "subheader": 2, "subsubheader": 3}
+
+class Document(DocNode):
+    """
+    Root section of a built document, see `build_doc_dict`
+    - headings: (item, number) per header/subheader/subsubheader in document
+    order, numbers are like '2.1' (see `index_headings`)
+    - toc_cache: table of contents list HTML per scope uid ('' for the whole
+    document), filled while rendering
+    - toc_uses: tables of contents rendered so far per scope uid, for their
+    heading ids (see `_inline_tableofcontents`), reset by `write_container`
+    - images: size and srcset per local image src, see `prepare_images`
     """
-    Build dictionary represntation of code found in `txt`
+    __slots__ = ("headings", "heading_numbers", "toc_cache", "toc_uses", "images")
+
+    def __init__(self, ident: int | str):
+        super().__init__("section", ident, [])
+        self.headings = []
+        self.heading_numbers = {}
+        self.toc_cache = {}
+        self.toc_uses = {}
+        self.images = {}
+
+    def index_headings(self, items: Iterable[DocNode]) -> None:
+        """
+        Number the headings among `items`, which must be in document order.
+        A subheader is numbered within the preceding header, and so on;
+        skipped levels count as 1.
+        """
+        headings = [item for item in items if item.type in _HEADING_LEVELS]
+        self.headings = list(zip(headings, _outline_numbers(headings)))
+        self.heading_numbers = {item.id: number for item, number in self.headings}
+        self.toc_cache = {}
+
+    def __repr__(self) -> str:
+        return f"Document({self.id})"
+
+def _outline_numbers(headings: list[DocNode]) -> list[str]:
+    # outline number per heading, like '2.1', counting only `headings`
+    counter = [0] * len(_HEADING_LEVELS)
+    numbers = []
+    for item in headings:
+        level = _HEADING_LEVELS[item.type]
+        counter[level - 1] += 1
+        counter[level:] = [0] * (len(counter) - level)
+        numbers.append(".".join(str(max(1, n)) for n in counter[:level]))
+    return numbers
+
+def build_doc_dict(txt: str, first_id: int=0) -> Document:
+    """
+    Build the document tree of code found in `txt`. Items are numbered in
+    creation order starting at `first_id`, so ids are the same on every build.
     Params:
     - txt: wbuild code
-    Returns: Dictionary
-    """
-    global TYPES
-    last_added_item = None
-    parts = extract_top_level_tags(txt)
-    doc = {
-        "type":"section",
-        "id":time.time_ns(),
-        "args":{
-            key: TYPES[0]["args"][key] for key in TYPES[0]["args"].keys()
-        },
-        "data":[],
-    }
-
+    - first_id: id of the document, items follow
+    Returns: document (a section DocNode), see `DocNode.to_dict` for the dict form
+    """
+    with _stage("tokenize"):
+        parts = extract_top_level_tags(txt)
+    with _stage("tree"):
+        return _build_tree(parts, first_id)
+
+def _build_tree(parts: Iterable[str], first_id: int) -> Document:
+    # doc tree from the parts of `extract_top_level_tags`, see `build_doc_dict`
+    doc = Document(first_id)
+    builder = _TreeBuilder(doc)
     for part in parts:
-        if is_type_tag(part):
-                # copy text into data
-            tag = delete_leading_whitespace(part)
-            last_added_item = process_tag(tag, doc, last_added_item)
-        elif is_args(part, last_added_item) :
-            process_args(part, last_added_item)
-        else:
-            itm = process_data(part, doc, last_added_item)
-            if not itm is None:
-                last_added_item = itm
+        builder.feed(part)
 
+    items = [item for item, _ in _walk(doc)]
+    for item in items:
+        parse_item_inline(item)
+    doc.index_headings(items)
     return doc
 
+class _TreeBuilder:
+    """
+    Adds the parts of `iter_top_level_tags` to a document one at a time.
+    Items only ever go into the last top-level item of the document (a
+    [section], or an item before the first one), so it is finished as soon
+    as the next top-level item starts. Only the items of the last top-level
+    item are indexed.
+    """
+    def __init__(self, doc: DocNode, detach: bool=False):
+        """
+        Params:
+        - doc: empty document to build
+        - detach: remove finished top-level items from `doc`, so that the
+        document never holds more than one
+        """
+        self.doc = doc
+        self.detach = detach
+        # id -> (item, parent), kept up to date by add_to_doc
+        self.index = {doc.id: (doc, None)}
+        self.next_id = doc.id + 1
+        self.last = None
+
+    def feed(self, part: str) -> DocNode | None:
+        """
+        Returns: the top-level item finished by `part`, if any
+        """
+        if is_type_tag(part):
+            item = create_doc_item(delete_leading_whitespace(part)[1:-1], ident=self.next_id)
+        elif (argdict := lex_args(part, self.last)) is not None:
+            if self.last is None:
+                raise TypeError(f"Last added item is none, but trying to add args {part}")
+            _apply_args(self.last, argdict)
+            return None
+        elif _fill_empty(part, self.last):
+            return None
+        else:
+            item = create_doc_item("text", part, self.next_id)
+        self.next_id += 1
+        n_top = len(self.doc.data)
+        add_to_doc(item, self.doc, self.last, self.index)
+        self.last = item
+        if len(self.doc.data) == n_top or n_top == 0:
+            return None
+        finished = self.doc.data[-2]
+        # items of `finished` were numbered from its id up to `item`'s
+        for ident in range(finished.id, item.id):
+            del self.index[ident]
+        if self.detach:
+            del self.doc.data[0]
+        return finished
+
+    def close(self) -> DocNode | None:
+        """
+        Returns: the last top-level item, None if the document is empty
+        """
+        if not self.doc.data:
+            return None
+        finished = self.doc.data[-1]
+        if self.detach:
+            self.doc.data.clear()
+        return finished
+
 def _style_html_from_argdict(argdict: dict[str, Any]) -> str:
     """
     Get CSS styling from `argdict`
@@ -167,249 +357,338 @@ def _style_html_from_argdict(argdict: dict[str, Any]) -> str:
                     html += "margin-top: 0px;"
     return html
 
-def _is_sec_or_col(part: dict[str, Any]) -> bool:
-    return part["type"] == "section" or part["type"] == "column"
+def _is_sec_or_col(part: DocNode) -> bool:
+    return part.type == "section" or part.type == "column"
 
-def _is_sec(part: dict) -> bool:
-    return part["type"] == "section"
+def _is_sec(part: DocNode) -> bool:
+    return part.type == "section"
 
-def _classes_from_argdict(part: dict[str, Any]) -> str:
+def _classes_from_argdict(part: DocNode) -> str:
     """
     Returns `part`'s classes in string, separated by space
     Params:
     - part: part dictionary
 
     """
-    argdict = part["args"]
+    argdict = part.args
     if 'bg' in argdict.keys():
         bg = "bg" + str(argdict['bg'])
     else:
         bg = 'bg0'
     col = ""
     if _is_sec_or_col(part):
-        n_cols = len([_part for _part in part["data"] if _part["type"] == "column"])
+        n_cols = len([_part for _part in part.data if _part.type == "column"])
         n_cols = n_cols if n_cols <= 3 else 3
         n_cols = n_cols if n_cols > 0 else 1
         col = f"columns{n_cols}"
     partclass = ""
-    if part["type"] == "code":
+    if part.type == "code":
         partclass = "code"
-    elif part['type'] == 'bq':
+    elif part.type == 'bq':
         partclass = 'bq'
     return f"{bg} {col} {partclass} {argdict['class']}"
 
-def _html_from_header(header: dict[str, Any], doc: dict[str, Any]) -> str:
+def _html_from_header(
+        header: DocNode, 
+        doc: DocNode, 
+        uids: Optional[dict[str, tuple]]=None) -> str:
     """
     Params:
     - `header`: header dictionary
     - `doc`: document dictionary
+    - `uids`: uid index of `doc` (see `build_uid_index`)
     Returns: Header HTML as string
     """
-    heading_size = len(re.findall(r"sub", header["type"])) + 1
+    heading_size = _HEADING_LEVELS[header.type]
     tag = f"h{heading_size}"
-    html = f"<{tag} id='{header['id']}'"
-    styles = _style_html_from_argdict(header["args"])
-    txt = header["args"]["label"]
-    txt = escape_non_cmds(txt)
-    txt = apply_text_cmds(txt, doc)
+    html = f"<{tag} id='{header.id}'"
+    styles = _style_html_from_argdict(header.args)
+    txt = render_inline(_inline_of(header, "label"), doc, uids)
+    if header.args["numbered"]:
+        number = _heading_numbers(doc).get(header.id)
+        if number is not None:
+            txt = f"{number} {txt}"
 
     if not _empty_or_ws_str(styles):
         html += f" style='{styles}'"
     return html + f">{txt}</{tag}>"
 
-def _html_from_code(code: dict[str, Any], mode=Literal['dark', 'light']) -> str:
+def _escape(text: str) -> str:
+    # same as html.escape, whose import loads the entity tables
+    return (text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        .replace('"', "&quot;").replace("'", "&#x27;"))
+
+def _theme_attr(mode: Optional[str]) -> str:
+    # data-theme attribute of an item, none for theme-neutral output
+    return f" data-theme='{mode}'" if mode is not None else ""
+
+def _html_from_code(code: DocNode, mode=Literal['dark', 'light']) -> str:
     """
     Params: 
     - code: code part's dictionary
-    - mode: document theme
+    - mode: document theme, None for theme-neutral HTML
     Returns: `code` part's HTML as str
     """
-    datastr = code["data"]
-    datastr = ht.escape(datastr).replace("\n", "<br>")
-    html = f"<div class='{_classes_from_argdict(code)}' data-theme='{mode}'"
-    html += f" id='{code['id']}'>"
+    datastr = code.data
+    datastr = _escape(datastr).replace("\n", "<br>")
+    html = f"<div class='{_classes_from_argdict(code)}'{_theme_attr(mode)}"
+    html += f" id='{code.id}'>"
     html += f"<pre>{datastr}</pre></div>"
     return html
 
-def _html_from_list(list_d: dict[str, Any], doc: dict[str, Any]) -> str:
+def _html_from_list(
+        list_d: DocNode, 
+        doc: DocNode, 
+        uids: Optional[dict[str, tuple]]=None) -> str:
     """
     Params:
     - list_d: list definition dict
     - doc: document dictionary
+    - uids: uid index of `doc` (see `build_uid_index`)
     Returns: HTML of `list_d` object as str
     """
-    dat = list_d["data"]
-    # dat = escape_non_cmds(dat).replace("\n", "<br>")
-    # dat = apply_text_cmds(dat, doc)
-    html = f"<pre class='list {list_d['args']['class']}' "
-    styles = _style_html_from_argdict(list_d['args'])
+    html = f"<pre class='list {list_d.args['class']}' "
+    styles = _style_html_from_argdict(list_d.args)
     html += f"style='{styles}'>"
 
-    n_levels = 3
-    escaped_lvls = re.escape(str(n_levels))
-    split_dat = re.split(r"(?:\n|\s?|^)(\*{1,"+escaped_lvls+r"}|#{1,"+escaped_lvls+r"}|-{1,"+escaped_lvls+r"})\)", dat)
-    split_dat = [sd.strip() for sd in split_dat if sd.strip()]
-    indicator = ""
+    n_levels = _LIST_LEVELS
     order_counter = [0,0,0] # count each level for numbering
     first_line = True
-    for sd in split_dat:
-        if re.match(r"^(\*{1,"+escaped_lvls+r"}|#{1,"+escaped_lvls+r"}|-{1,"+escaped_lvls+r"})$", sd):
-            indicator = sd
+    for indicator, sd in _inline_of(list_d, "data"):
+        level = len(indicator)
+        # prespace = " " * level * list_d.args["lvloffset"]
+        prespace = " " * list_d.args["lvloffset"] * (level - 1) + list_d.args["baseoffset"] * " "
+
+        symbol = "•" if indicator[0] == "*" else " "
+        if indicator[0] == "#":
+            symbol = ""
+            for i in range(level):
+                if i == level - 1 and i < n_levels:
+                    order_counter[i] += 1
+                    # reset counter of higher levels
+                    for j in range(i + 1, n_levels):
+                        order_counter[j] = 0
+                symbol += f"{max(1,order_counter[i])}{'.' if i < level - 1 else ''}"
+        elif list_d.args["orderall"]:
+            for i in range(level):
+                if i == level - 1 and i < n_levels:
+                    order_counter[i] += 1
+                    # reset counter of higher levels
+                    for j in range(i + 1, n_levels):
+                        order_counter[j] = 0
+        presequence = prespace + symbol + " "
+        # presequence = _escape(presequence)
+        sd = render_inline(sd, doc, uids)
+        if not first_line:
+            html += "<br>"
         else:
-            level = len(indicator)
-            # prespace = " " * level * list_d["args"]["lvloffset"]
-            prespace = " " * list_d["args"]["lvloffset"] * (level - 1) + list_d["args"]["baseoffset"] * " "
-
-            symbol = "•" if indicator[0] == "*" else " "
-            if indicator[0] == "#":
-                symbol = ""
-                for i in range(level):
-                    if i == level - 1 and i < n_levels:
-                        order_counter[i] += 1
-                        # reset counter of higher levels
-                        for j in range(i + 1, n_levels):
-                            order_counter[j] = 0
-                    symbol += f"{max(1,order_counter[i])}{'.' if i < level - 1 else ''}"
-            elif list_d["args"]["orderall"]:
-                for i in range(level):
-                    if i == level - 1 and i < n_levels:
-                        order_counter[i] += 1
-                        # reset counter of higher levels
-                        for j in range(i + 1, n_levels):
-                            order_counter[j] = 0
-            presequence = prespace + symbol + " "
-            # presequence = ht.escape(presequence)
-            sd = escape_non_cmds(sd)
-            sd = apply_text_cmds(sd, doc)
-            if not first_line:
-                html += "<br>"
-            else:
-                first_line = False
-            html += presequence + sd
+            first_line = False
+        html += presequence + sd
     html += "</pre>"
     return html
 
 
-def _html_from_img(img: dict[str, Any], doc: dict[str, Any]) -> str:
+def _html_from_img(
+        img: DocNode, 
+        doc: DocNode, 
+        uids: Optional[dict[str, tuple]]=None) -> str:
     """
     Params:
     - img: image dictionary
     - doc: document dictionary
+    - uids: uid index of `doc` (see `build_uid_index`)
     Returns: HTML str from image
     """
-    styles = f" style='{_style_html_from_argdict(img['args'])}'"
+    styles = f" style='{_style_html_from_argdict(img.args)}'"
     if styles == " style=''":
         styles = ""
-    imghtml = f"<figure id='{img['id']}' style='margin: 0;'>"
-    imghtml += f"<img class='{_classes_from_argdict(img)}' src='{img['args']['src']}'{styles}>"
+    attrs = " loading='lazy' decoding='async'"
+    info = doc.images.get(img.args["src"]) if isinstance(doc, Document) else None
+    if info is not None:
+        attrs = f" width='{info['width']}' height='{info['height']}'" + attrs
+        if info["srcset"]:
+            attrs += f" srcset='{info['srcset']}'"
+    imghtml = f"<figure id='{img.id}' style='margin: 0;'>"
+    imghtml += f"<img class='{_classes_from_argdict(img)}' src='{img.args['src']}'{attrs}{styles}>"
     captionhtml = ""
-    caption = img["args"]["caption"]
+    caption = img.args["caption"]
     if caption != "":
-        caption = escape_non_cmds(caption)
-        caption = apply_text_cmds(caption, doc)
+        caption = render_inline(_inline_of(img, "caption"), doc, uids)
         captionhtml = (f"<figcaption style='margin-top: -1%'>"
-            +f"{'<i>' if img['args']['italicize'] else ''}{caption}"
-            +f"{'</i>' if img['args']['italicize'] else ''}</figcaption>")
+            +f"{'<i>' if img.args['italicize'] else ''}{caption}"
+            +f"{'</i>' if img.args['italicize'] else ''}</figcaption>")
     captionhtml += "</figure>"
     return imghtml + captionhtml
 
-def _html_from_bq(part: dict[str, Any], mode=Literal['dark', 'light']) -> str:
+def _html_from_bq(part: DocNode, mode=Literal['dark', 'light']) -> str:
     """
     Params:
     - part: blockquote part's dictionary
     - doc: document dictionary
     Returns: HTML str from `part`
     """
-    datastr = part['data']
-    datastr = ht.escape(datastr).replace("\n", "<br>")
-    if part['args']['italicize']:
+    datastr = part.data
+    datastr = _escape(datastr).replace("\n", "<br>")
+    if part.args['italicize']:
         datastr = '<i>' + datastr + '</i>'
-    html = f"<blockquote class='{_classes_from_argdict(part)}' data-theme='{mode}' "
-    html += f"style='{_style_html_from_argdict(part['args'])}'>{datastr}</blockquote>"
+    html = f"<blockquote class='{_classes_from_argdict(part)}'{_theme_attr(mode)} "
+    html += f"style='{_style_html_from_argdict(part.args)}'>{datastr}</blockquote>"
     return html
 
-def _html_from_text(part: dict[str, Any], doc: dict[str, Any]) -> str:
+def _html_from_text(
+        part: DocNode, 
+        doc: DocNode, 
+        uids: Optional[dict[str, tuple]]=None) -> str:
     """
     Params:
     - part: text part's dictionary
     - doc: document dictionary
+    - uids: uid index of `doc` (see `build_uid_index`)
     Returns: HTML str from `part`
     """
-    datastr = part["data"]
-    datastr = escape_non_cmds(datastr).replace("\n","<br>")
-    datastr = apply_text_cmds(datastr, doc)
-    return f"<p class='{part['args']['class']}' id='{part['id']}'>" + datastr + "</p>"
+    datastr = render_inline(_inline_of(part, "data"), doc, uids, br=True)
+    return f"<p class='{part.args['class']}' id='{part.id}'>" + datastr + "</p>"
+
+_EMPTY_OR_WS = re.compile(r"^\s?$")
 
 def _empty_or_ws_str(string: str) -> bool:
-    return re.match(r"^\s?$", string)
+    return _EMPTY_OR_WS.match(string)
 
-def _html_from_container(
-        section: dict[str, Any], 
+def _writer(out) -> Callable[[str], Any]:
+    """
+    Params:
+    - out: file-like object (anything with `write`), list sink or callable
+    Returns: function writing one HTML fragment to `out`
+    """
+    if hasattr(out, "write"):
+        return out.write
+    if isinstance(out, list):
+        return out.append
+    if callable(out):
+        return out
+    raise TypeError(f"Can't write HTML to {type(out).__name__}")
+
+def write_container(
+        section: DocNode, 
+        out,
         mode=Literal['dark', 'light'], 
-        doc: Optional[dict[str, Any]]=None) -> str:
+        doc: Optional[DocNode]=None,
+        uids: Optional[dict[str, tuple]]=None,
+        extra_class: str="") -> None:
     """
-    Recursively build HTML string from contained objects in `section`,
-    including styling, classes, theming
+    Recursively write HTML from contained objects in `section` to `out`,
+    including styling, classes, theming. Fragments are written as they are
+    rendered, nested containers don't build strings of their children.
     Params:
     - section: dictionary for a section or column object
-    - mode: document theme
+    - out: file-like object, list sink or callable (see `_writer`)
+    - mode: document theme, None to leave the theme to the page's body
+    (theme-neutral HTML, see `write_pages`)
     - doc: if left None, `section` is treated as document
-    Returns: HTML str
+    - uids: uid index of `doc`, built once if left None and shared
+    with all contained objects
+    - extra_class: class added to `section`'s div only
     """
     if doc is None:
         doc = section
-
-    html = f"<div id='{section['id']}' "
-    # cols = [part for part in section['data'] if _is_sec(part)]
-    html += f"class='{_classes_from_argdict(section)}'"
-    html += f" data-theme='{mode}' data-type='sec/col'"
-    styles = _style_html_from_argdict(section['args'])
+        if isinstance(doc, Document):
+            doc.toc_uses = {}
+    if uids is None:
+        uids = build_uid_index(doc)
+    write = _writer(out)
+    write(_container_open(section, mode, extra_class))
+    _write_parts(section.data, write, mode, doc, uids)
+    write("</div>")
+
+def _container_open(section: DocNode, mode: Optional[str], extra_class: str="") -> str:
+    # opening div of a section/column, see `write_container`
+    html = f"<div id='{section.id}' "
+    # cols = [part for part in section.data if _is_sec(part)]
+    html += f"class='{_classes_from_argdict(section)}{' ' + extra_class if extra_class else ''}'"
+    html += f"{_theme_attr(mode)} data-type='sec/col'"
+    styles = _style_html_from_argdict(section.args)
     styles += "overflow:wrap;"
     if not _empty_or_ws_str(styles):
         html += f" style='{styles}' "
-    html += ">"
-    for part in section["data"]:
-        match part["type"]:
+    return html + ">"
+
+def _write_parts(
+        parts: Iterable[DocNode], 
+        write: Callable[[str], Any], 
+        mode: Optional[str], 
+        doc: DocNode, 
+        uids: dict[str, tuple]) -> None:
+    # write the HTML of the items of a container, see `write_container`
+    prof = _profile.get()
+    for part in parts:
+        if prof is not None:
+            start = time.perf_counter()
+        match part.type:
             case "section" | "column":
-                html += _html_from_container(part, mode, doc)
+                write_container(part, write, mode, doc, uids)
             case "header" | "subheader" | "subsubheader":
-                html += _html_from_header(part, doc)
+                write(_html_from_header(part, doc, uids))
             case "text":
-                html += _html_from_text(part, doc)
+                write(_html_from_text(part, doc, uids))
             case "code":
-                html += _html_from_code(part, mode)
+                write(_html_from_code(part, mode))
             case "img":
-                html += _html_from_img(part, doc)
+                write(_html_from_img(part, doc, uids))
             case "list":
-                html += _html_from_list(part, doc)
+                write(_html_from_list(part, doc, uids))
             case 'bq':
-                html += _html_from_bq(part, mode)
-    html += "</div>"
-    return html
+                write(_html_from_bq(part, mode))
+        if prof is not None and not _is_sec_or_col(part):
+            prof.add_render(part.type, time.perf_counter() - start)
 
-def _bsoup_from_footer(fpath: str):
-    ffile = open(fpath)
-    ftxt = ffile.read()
-    ffile.close()
-    fsec = build_doc_dict(ftxt)
-    fhtml_txt = _html_from_container(fsec, 'footer')
-    fhtml = BeautifulSoup(fhtml_txt, 'html.parser')
+def _html_from_container(
+        section: DocNode, 
+        mode=Literal['dark', 'light'], 
+        doc: Optional[DocNode]=None,
+        uids: Optional[dict[str, tuple]]=None) -> str:
+    """
+    Build HTML string from contained objects in `section`, see `write_container`
+    Returns: HTML str
+    """
+    sink = []
+    write_container(section, sink, mode, doc, uids)
+    return "".join(sink)
+
+def load_footer(fpath: str) -> DocNode:
+    """
+    Params:
+    - fpath: footer file path
+    Returns: document dictionary of the footer
+    """
+    with open(fpath) as ffile:
+        ftxt = ffile.read()
+    return build_doc_dict(ftxt, FOOTER_FIRST_ID)
 
-    container = fhtml.find('div')
-    container['class'] = container.get('class', []) + ['footer-parent']
-    return container
+def write_footer(footer: DocNode, out) -> None:
+    """
+    Write the footer document as a container with the `footer-parent` class
+    Params:
+    - footer: footer document dictionary (see `load_footer`)
+    - out: file-like object, list sink or callable (see `_writer`)
+    """
+    write_container(footer, out, 'footer', extra_class='footer-parent')
 
 def create_and_append_footer(fpath: str, document_html: str):
-    doc = BeautifulSoup(document_html, 'html.parser')
-    body = doc.body.find('div')
-    footer_div = _bsoup_from_footer(fpath)
-    if body and footer_div:
-        body.append(footer_div)
-    else:
+    """
+    Insert the footer at `fpath` at the end of the main div of an already
+    built page. `html_from_dict`'s `footer` parameter does the same while rendering.
+    Params:
+    - fpath: footer file path
+    - document_html: page HTML from `html_from_dict`
+    Returns: page HTML with footer
+    """
+    main_end = document_html.rfind('</div></body>')
+    if main_end < 0:
         raise Exception("Error creating footer or parsing body")
-
-    result = str(doc)
-    return result
+    sink = [document_html[:main_end]]
+    write_footer(load_footer(fpath), sink)
+    sink.append(document_html[main_end:])
+    return "".join(sink)
 
 def _get_html_theme_button(mode: str):
     icon = f"https://raw.githubusercontent.com/kristianleoruth/wbuild/refs/heads/main/assets/moon.png"
@@ -420,142 +699,605 @@ def _get_html_theme_button(mode: str):
     return html
 
 
-def _get_local_js_imports():
+# path -> contents of files read by _read_asset
+_assets = {}
+
+def _read_asset(path: str) -> str:
     """
-    Returns script tags in a string referencing local files
+    Returns contents of `path`, read from disk only on first use in this process
     """
-    paths = [
+    if not path in _assets:
+        with open(path) as asset:
+            _assets[path] = asset.read()
+    return _assets[path]
+
+def _asset_paths() -> list[str]:
+    return [_style_path(), *_js_paths(), *_search_paths()]
+
+def _style_path() -> str:
+    return os.path.abspath(os.path.join(scr_dir, "base_styles.css"))
+
+def _js_paths() -> list[str]:
+    return [
         os.path.join(scr_dir, "js/toggle_theme.js")
     ]
+
+def _search_style_path() -> str:
+    return os.path.abspath(os.path.join(scr_dir, "search_styles.css"))
+
+def _search_js_path() -> str:
+    return os.path.join(scr_dir, "js/search.js")
+
+def _search_paths() -> list[str]:
+    # assets only included in pages with a search box, see `_get_html_search_box`
+    return [_search_style_path(), _search_js_path()]
+
+def _get_html_search_box(index_url: str, asset_urls: Optional[dict[str, str]]=None) -> str:
+    """
+    Returns: search box querying the index at `index_url`, with its style
+    rules inlined, or linked if `asset_urls` is given
+    """
+    if asset_urls is None:
+        html = f"<style>{_read_asset(_search_style_path())}</style>"
+    else:
+        html = f"<link rel='stylesheet' href='{asset_urls[_search_style_path()]}'>"
+    html += f"<div class='search' data-index='{_escape(index_url)}'>"
+    html += "<input type='search' placeholder='Search' aria-label='Search'><ul class='search-results'></ul></div>"
+    return html
+
+def _get_local_js_imports(asset_urls: Optional[dict[str, str]]=None, search: bool=False):
+    """
+    Returns script tags in a string with the local scripts inlined, or
+    linked if `asset_urls` is given (see `asset_urls`). `search` adds the
+    search box script.
+    """
     imp = ""
-    for path in paths:
-        imp +=  f"<script>{open(path).read()}</script>"
+    for path in _js_paths() + ([_search_js_path()] if search else []):
+        if asset_urls is None:
+            imp +=  f"<script>{_read_asset(path)}</script>"
+        else:
+            imp += f"<script src='{asset_urls[path]}'></script>"
     return imp
 
-def html_from_dict(
-        section: dict[str, Any], 
+# path -> (contents, name) of assets named by _asset_name, the name is used
+# while `_assets` holds the same contents (dropping them there renames)
+_asset_names = {}
+
+def _asset_name(path: str) -> str:
+    """
+    Returns: file name of the asset at `path` with a hash of its contents,
+    e.g. 'base_styles.3fa2c1d0.css', hashed once per contents
+    """
+    contents = _read_asset(path)
+    known = _asset_names.get(path)
+    if known is not None and known[0] is contents:
+        return known[1]
+    import hashlib
+    stem, ext = os.path.splitext(os.path.basename(path))
+    digest = hashlib.sha256(contents.encode()).hexdigest()[:8]
+    name = f"{stem}.{digest}{ext}"
+    _asset_names[path] = (contents, name)
+    return name
+
+def write_assets(assets_dir: str, precompress: bool=False, search: bool=False) -> list[str]:
+    """
+    Write the style sheet and scripts to `assets_dir` under content-hashed
+    names (see `_asset_name`), so they can be cached indefinitely. Files
+    already there are kept, as their names imply their contents.
+    Params:
+    - precompress: also write gzip copies (see `write_gzip`)
+    - search: also write the search box style sheet and script
+    Returns: written or existing asset paths
+    """
+    os.makedirs(assets_dir, exist_ok=True)
+    paths = []
+    for path in _asset_paths():
+        if path in _search_paths() and not search:
+            continue
+        dest = os.path.join(assets_dir, _asset_name(path))
+        if not os.path.exists(dest):
+            # write then rename, so a partial file is never seen under the final name
+            tmp = f"{dest}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(_read_asset(path))
+            os.replace(tmp, dest)
+        if precompress and not os.path.exists(dest + ".gz"):
+            write_gzip(dest)
+        paths.append(dest)
+    return paths
+
+def asset_urls(assets_dir: str, page_dir: str) -> dict[str, str]:
+    """
+    Params:
+    - assets_dir: directory the assets are written to by `write_assets`
+    - page_dir: directory of the page linking them
+    Returns: asset path -> URL relative to `page_dir`
+    """
+    return {
+        path: os.path.relpath(os.path.join(assets_dir, _asset_name(path)), page_dir).replace(os.sep, "/")
+        for path in _asset_paths()
+    }
+
+def write_html(
+        section: DocNode, 
+        out,
         mode='dark', 
         footer_cmp_mode=False, 
         title='Wbuild Page',
         favicon='',
-    ) -> str:
+        footer: Optional[DocNode]=None,
+        asset_urls: Optional[dict[str, str]]=None,
+        search_index: Optional[str]=None,
+    ) -> None:
     """
+    Stream the full page to `out`, see `html_from_dict`
     Params:
     - `section`: dictionary for a section or column object
+    - `out`: file-like object, list sink or callable (see `_writer`)
     - `mode`: page theme
     - `footer_cmp_mode`: set body to be grid of two for footer
     - `title`: page title (tab name)
-    Returns: Ready-to-build HTML string including html tags, etc.
+    - `footer`: footer document dictionary (see `load_footer`), implies `footer_cmp_mode`
+    - `asset_urls`: link the style sheet and scripts at these URLs (see
+    `asset_urls`) instead of inlining them
+    - `search_index`: URL of the site's search index, adds a search box (see
+    `write_search_index`)
     """
+    footer_cmp_mode = footer_cmp_mode or footer is not None
+    write = _writer(out)
+    with _stage("render"):
+        write(_page_head(mode, footer_cmp_mode, title, favicon, asset_urls))
+        write_container(section, write, mode)
+        write(_page_scripts(mode, asset_urls, search_index))
+    if footer is not None:
+        with _stage("footer"):
+            write_footer(footer, write)
+    write('</div></body></html>')
+
+def _page_head(
+        mode: str, 
+        footer_cmp_mode: bool, 
+        title: str, 
+        favicon: str, 
+        asset_urls: Optional[dict[str, str]],
+        style_sheet: Optional[str]=None) -> str:
+    # page HTML up to the document, see `write_html`. `style_sheet` replaces
+    # the inlined style sheet, e.g. pruned by `_critical_head`
     html = f"<!DOCTYPE html><html><head><title>{title}</title>"
     if favicon != '':
         html += f"<link rel='icon' href='{favicon}'>"
-    style_path = os.path.abspath(os.path.join(scr_dir, "base_styles.css"))
-    html += '<style>' + open(f"{style_path}").read() + '</style>'
+    if asset_urls is None:
+        html += '<style>' + (style_sheet if style_sheet is not None else _read_asset(_style_path())) + '</style>'
+    else:
+        html += f"<link rel='stylesheet' href='{asset_urls[_style_path()]}'>"
     html += '<meta charset=\'UTF-8\'></head>'
     html += f"<body class='bg1{' footer-compatible' if footer_cmp_mode else ''}' data-theme='{mode}'x><div class='main'>"
-    html += _html_from_container(section, mode)
-    html += _get_html_theme_button(mode)
-    html += _get_local_js_imports()
-    html += '</div></body></html>'
     return html
 
-def create_doc_item(tag: str, data: str="") -> dict:
+def _critical_head(
+        page: list[str], 
+        mode: str, 
+        footer_cmp_mode: bool, 
+        title: str, 
+        favicon: str) -> str:
+    """
+    Returns: head of the full `page` (fragments, the first is its head)
+    with only the style rules its elements may use, see `prune_css`
+    """
+    style_sheet = prune_css(_read_asset(_style_path()), used_selectors(page))
+    return _page_head(mode, footer_cmp_mode, title, favicon, None, style_sheet)
+
+def _page_scripts(mode: str, asset_urls: Optional[dict[str, str]], search_index: Optional[str]=None) -> str:
+    # page HTML between the document and the footer
+    html = _get_html_theme_button(mode)
+    if search_index is not None:
+        html += _get_html_search_box(search_index, asset_urls)
+    return html + _get_local_js_imports(asset_urls, search_index is not None)
+
+_MIN_TOKEN = re.compile(
+    r"""<!--.*?-->|<(/?)([a-zA-Z][\w-]*)((?:\s+[^\s=>/]+(?:\s*=\s*(?:'[^']*'|"[^"]*"|[^\s'"=<>`]+))?)*)\s*(/?)>""", 
+    re.S)
+_MIN_ATTR = re.compile(r"""\s+([^\s=>/]+)(?:\s*=\s*('[^']*'|"[^"]*"|[^\s'"=<>`]+))?""")
+_MIN_CSS = re.compile(r"""("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|\s*([{};,>])\s*|\s+""")
+_CSS_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+_WS = re.compile(r"\s+")
+# elements whose contents are not HTML, and those whose whitespace is kept
+_RAW_TEXT_TAGS = ("script", "style")
+_PRE_TAGS = ("pre", "textarea")
+# class of the rule replacing the n-th repeated inline style
+_STYLE_CLASS = "wb-s{}"
+
+def minify_css(css: str) -> str:
+    """
+    Returns: `css` without comments and with whitespace collapsed, strings are kept
+    """
+    css = _CSS_COMMENT.sub("", css)
+    return _MIN_CSS.sub(lambda m: m.group(1) or m.group(2) or " ", css).strip()
+
+def _tidy_style(style: str) -> str:
+    decls = []
+    for decl in style.split(";"):
+        prop, colon, value = decl.partition(":")
+        if prop.strip():
+            decls.append(f"{prop.strip()}{colon}{_WS.sub(' ', value.strip())}")
+    return ";".join(decls)
+
+class HtmlMinifier:
+    """
+    Minifies HTML a fragment at a time, as it is written by the renderers:
+    drops comments and empty class/style attributes, tidies class and style
+    values, collapses whitespace outside <pre> and minifies inline CSS.
+    Fragments must not split tags (the renderers never do).
+
+    If `style_classes` is given, style attributes with those values are
+    replaced by the class they map to, and the rules for those classes are
+    added before </head>, see `minify_page`.
+    """
+    def __init__(self, style_classes: Optional[dict[str, str]]=None):
+        self.style_classes = style_classes or {}
+        # style attribute values seen
+        self.styles = Counter()
+        self.saw_head = False
+        # raw text element being read, depth of <pre> elements
+        self._raw = None
+        self._pre = 0
+
+    def feed(self, html: str) -> str:
+        out = []
+        pos = 0
+        while pos < len(html):
+            if self._raw is not None:
+                end = html.lower().find(f"</{self._raw}", pos)
+                end = len(html) if end < 0 else end
+                text = html[pos:end]
+                out.append(minify_css(text) if self._raw == "style" else text)
+                pos = end
+                if end == len(html):
+                    break
+            match = _MIN_TOKEN.search(html, pos)
+            end = match.start() if match else len(html)
+            if end > pos:
+                text = html[pos:end]
+                out.append(text if self._pre else _WS.sub(" ", text))
+            if match is None:
+                break
+            pos = match.end()
+            if match.group(2) is not None:
+                out.append(self._tag(match))
+        return "".join(out)
+
+    def _tag(self, match: re.Match) -> str:
+        closing, name, attrs, void = match.groups()
+        name_l = name.lower()
+        if closing:
+            if name_l in _PRE_TAGS:
+                self._pre = max(0, self._pre - 1)
+            elif name_l in _RAW_TEXT_TAGS:
+                self._raw = None
+            elif name_l == "head":
+                self.saw_head = True
+                if self.style_classes:
+                    return f"<style>{self._class_rules()}</style></head>"
+            return f"</{name}>"
+        if name_l in _PRE_TAGS:
+            self._pre += 1
+        elif name_l in _RAW_TEXT_TAGS:
+            self._raw = name_l
+        html = f"<{name}"
+        classes = None
+        for attr in _MIN_ATTR.finditer(attrs):
+            key, value = attr.groups()
+            key_l = key.lower()
+            if value is None or not key_l in ("class", "style"):
+                html += f" {key}" if value is None else f" {key}={value}"
+                continue
+            inner = value[1:-1] if value[0] in "'\"" else value
+            if key_l == "class":
+                classes = inner.split() if classes is None else classes + inner.split()
+                continue
+            style = _tidy_style(inner)
+            if not style:
+                continue
+            self.styles[style] += 1
+            if style in self.style_classes:
+                classes = (classes or []) + [self.style_classes[style]]
+            else:
+                html += f" style='{style}'" if not "'" in style else f' style="{style}"'
+        if classes:
+            html += f" class='{' '.join(classes)}'"
+        return html + (" /" if void else "") + ">"
+
+    def _class_rules(self) -> str:
+        # inline styles override the style sheet, so the rules replacing them are important
+        rules = []
+        for style, cls in self.style_classes.items():
+            decls = ";".join(
+                decl if decl.endswith("!important") else decl + "!important" 
+                for decl in style.split(";"))
+            rules.append(f".{cls}{{{decls}}}")
+        return "".join(rules)
+
+def minify_page(fragments: Iterable[str], min_count: int=2) -> list[str]:
+    """
+    Minify a full page written as `fragments`, see `HtmlMinifier`. Inline
+    styles used at least `min_count` times are replaced by a class each.
+    Returns: minified fragments
+    """
+    fragments = list(fragments)
+    counter = HtmlMinifier()
+    for fragment in fragments:
+        counter.feed(fragment)
+    style_classes = {}
+    if counter.saw_head:
+        repeated = [style for style, count in counter.styles.most_common() if count >= min_count]
+        style_classes = {style: _STYLE_CLASS.format(i) for i, style in enumerate(repeated)}
+    minifier = HtmlMinifier(style_classes)
+    return [minifier.feed(fragment) for fragment in fragments]
+
+_USED_TAG = re.compile(r"<([a-zA-Z][\w-]*)")
+_USED_CLASS = re.compile(r"""\sclass\s*=\s*(?:'([^']*)'|"([^"]*)")""", re.I)
+# parts of a selector that don't narrow down which elements it needs
+_SEL_FUNC = re.compile(r":{1,2}[\w-]+\((?:[^()]|\([^()]*\))*\)")
+_SEL_IGNORED = re.compile(r"\[[^\]]*\]|::?[\w-]+|#-?[_a-zA-Z][\w-]*")
+_SEL_TOKEN = re.compile(r"(\.?)(-?[_a-zA-Z][\w-]*)")
+# class of an element filled by a script -> element names and classes the script adds
+_SCRIPT_SELECTORS = {
+    ".search-results": {"li", "a", ".link"},
+}
+
+def used_selectors(fragments: Iterable[str]) -> set[str]:
+    """
+    Element names and classes ('.name') used in the HTML `fragments`,
+    including the ones the page's scripts create (see `_SCRIPT_SELECTORS`).
+    Text is escaped by the renderers, so anything looking like a tag is one;
+    at worst a few unused names are included.
+    """
+    used = set()
+    for fragment in fragments:
+        used.update(name.lower() for name in _USED_TAG.findall(fragment))
+        for single, double in _USED_CLASS.findall(fragment):
+            used.update("." + cls for cls in (single or double).split())
+    for cls, added in _SCRIPT_SELECTORS.items():
+        if cls in used:
+            used |= added
+    return used
+
+def _selector_needs(selector: str) -> frozenset[str]:
+    # element names and classes an element must have for `selector` to match
+    selector = _SEL_IGNORED.sub(" ", _SEL_FUNC.sub(" ", selector))
+    return frozenset(
+        dot + (name if dot else name.lower()) for dot, name in _SEL_TOKEN.findall(selector))
+
+def _css_blocks(css: str) -> Iterator[tuple[str, Optional[str]]]:
+    # (prelude, body) of each top-level rule in `css`, body None for statements like @import
+    pos = 0
+    start = 0
+    depth = 0
+    body_start = 0
+    while pos < len(css):
+        c = css[pos]
+        if c in "'\"":
+            end = css.find(c, pos + 1)
+            while end > 0 and css[end - 1] == "\\":
+                end = css.find(c, end + 1)
+            pos = len(css) if end < 0 else end + 1
+            continue
+        if c == "{":
+            if depth == 0:
+                body_start = pos + 1
+            depth += 1
+        elif c == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield css[start:body_start - 1].strip(), css[body_start:pos]
+                start = pos + 1
+        elif c == ";" and depth == 0:
+            if css[start:pos].strip():
+                yield css[start:pos].strip(), None
+            start = pos + 1
+        pos += 1
+
+class CssIndex:
+    """
+    Rules of a style sheet, indexed by an element name or class each of
+    their selectors needs, for `prune`. @media and @supports rules are
+    pruned by their contents, other at-rules are always kept.
+    """
+    def __init__(self, css: str):
+        # per rule: (prelude, [(selector, needs)], body), (prelude, CssIndex)
+        # for @media/@supports or (text,) if always kept
+        self.rules = []
+        # name or class -> indices of rules with a selector needing it
+        self.by_need = {}
+        # indices of rules kept whatever the page uses
+        self.always = set()
+        for prelude, body in _css_blocks(_CSS_COMMENT.sub("", css)):
+            i = len(self.rules)
+            if body is None:
+                self.rules.append((prelude + ";",))
+                self.always.add(i)
+            elif prelude.startswith("@"):
+                if prelude.split()[0].lower() in ("@media", "@supports"):
+                    self.rules.append((prelude, CssIndex(body)))
+                else:
+                    self.rules.append((f"{prelude}{{{body}}}",))
+                self.always.add(i)
+            else:
+                selectors = [(sel.strip(), _selector_needs(sel)) for sel in prelude.split(",")]
+                self.rules.append((prelude, selectors, body))
+                for _, needs in selectors:
+                    if needs:
+                        self.by_need.setdefault(min(needs), set()).add(i)
+                    else:
+                        self.always.add(i)
+
+    def prune(self, used: set[str]) -> str:
+        """
+        Returns: the rules with a selector that may match on a page using
+        only the names and classes in `used` (see `used_selectors`), without
+        their other selectors
+        """
+        candidates = set(self.always)
+        for need in used:
+            candidates |= self.by_need.get(need, set())
+        css = []
+        for i in sorted(candidates):
+            rule = self.rules[i]
+            if len(rule) == 1:
+                css.append(rule[0])
+            elif isinstance(rule[1], CssIndex):
+                inner = rule[1].prune(used)
+                if inner:
+                    css.append(f"{rule[0]}{{{inner}}}")
+            else:
+                selectors = [sel for sel, needs in rule[1] if needs <= used]
+                if selectors:
+                    css.append(f"{', '.join(selectors)} {{{rule[2].rstrip()}\n}}")
+        return "\n".join(css)
+
+# style sheet text -> its CssIndex, parsed once per process
+_css_indexes = {}
+
+def prune_css(css: str, used: set[str]) -> str:
+    """
+    Returns: the rules of `css` that may apply on a page using the element
+    names and classes in `used`, see `CssIndex.prune`
+    """
+    index = _css_indexes.get(css)
+    if index is None:
+        index = _css_indexes[css] = CssIndex(css)
+    return index.prune(used)
+
+def write_gzip(path: str) -> str:
+    """
+    Write a gzip compressed copy of `path` to `path`.gz, for servers that
+    send precompressed files. The copy only depends on the contents of `path`.
+    Returns: path of the copy
+    """
+    import gzip
+    with open(path, "rb") as f:
+        data = f.read()
+    dest = path + ".gz"
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    os.replace(tmp, dest)
+    return dest
+
+def _finish_output(path: str, precompress: bool) -> None:
+    # write or remove the .gz copy of an output file, so that a stale one is never served
+    if precompress:
+        write_gzip(path)
+    elif os.path.exists(path + ".gz"):
+        os.remove(path + ".gz")
+
+def html_from_dict(
+        section: DocNode, 
+        mode='dark', 
+        footer_cmp_mode=False, 
+        title='Wbuild Page',
+        favicon='',
+        footer: Optional[DocNode]=None,
+        asset_urls: Optional[dict[str, str]]=None,
+    ) -> str:
+    """
+    Params:
+    - `section`: dictionary for a section or column object
+    - `mode`: page theme
+    - `footer_cmp_mode`: set body to be grid of two for footer
+    - `title`: page title (tab name)
+    - `footer`: footer document dictionary (see `load_footer`), rendered at
+    the end of the main div
+    - `asset_urls`: link assets instead of inlining them, see `write_html`
+    Returns: Ready-to-build HTML string including html tags, etc.
+    """
+    sink = []
+    write_html(section, sink, mode, footer_cmp_mode, title, favicon, footer, asset_urls)
+    return "".join(sink)
+
+def create_doc_item(tag: str, data: str="", ident: Optional[int | str]=None) -> DocNode:
     """
     If `tag` is 'section' or 'column', data is empty list (to
     store other doc items
 
-    Doc dict structure:
-    - 'type': str,
-    - 'id': int,
-    - 'args': dict[str, Any],
-    - 'data': `data`
+    See `DocNode` for the item structure.
     Params:
     - tag: string literal type of object ('section', 'header', etc.)
     - data: data string can be used if `tag` is not 'section' or 'column'
+    - ident: id of the item, unique within its document. If left None, a
+    process-wide counter is used
 
     Returns: doc item corresponding to `tag`, with appended `data`.
     """
-    global TYPES
-    t_idx = [item["type"] for item in TYPES].index(tag)
-    type_info = TYPES[t_idx]
-    if type_info["type"] == "section" or type_info["type"] == "column":
+    if not tag in _TYPE_ARGS:
+        raise ValueError(f"Unknown type: {tag}")
+    if tag == "section" or tag == "column":
         data = []
-    item_dict = {
-        "type": type_info["type"],
-        "id": time.time_ns(),
-        "args": {arg:type_info["args"][arg] for arg in type_info["args"]},
-        "data": data,
-    }
-    return item_dict
-
-def process_tag(tagstr: str, doc: dict[str, Any], last_added_item: Optional[dict[str, Any]]) -> dict:
-    """
-    
-    """
-    global TYPES
-    tag = tagstr[1:-1]
-    item_dict = create_doc_item(tag)
-    # if _is_sec(item_dict) and not last_added_item is None:
-    #     # attach to parent of previously added, if it's a section we start a new one
-    #     _, last_added_item = search_section(doc, last_added_item["id"])
-    add_to_doc(item_dict, doc, last_added_item)
-    # doc["data"].append(item_dict)
-    return item_dict
-
-def process_args(argstr: str, last_added_item: dict) -> None:
-    global TYPES
-    if last_added_item is None:
-        raise TypeError(f"Last added item is none, but trying to add args {argstr}")
-    # alter last item in doc dict with new args
-    argdict = parse_args(argstr)
+    return DocNode(tag, next(_loose_ids) if ident is None else ident, data)
+
+def _apply_args(item: DocNode, argdict: dict[str, str]) -> None:
+    """
+    Set args of `item` from strings, converted with the coercers in `SCHEMA`.
+    Unknown args are ignored.
+    """
+    specs = SCHEMA[item.type]
     for arg, argval in argdict.items():
-        t_idx = [item["type"] for item in TYPES].index(last_added_item["type"])
-        type_info = TYPES[t_idx]
-        if arg in type_info["args"].keys():
-            val = argval
-            valtype = type(type_info["args"][arg])
-            if valtype == int:
-                val = int(argval)
-            elif valtype == float:
-                val = float(argval)
-            elif valtype == bool:
-                val = bool(argval)
-            elif valtype == str:
-                val = val.strip()
-            last_added_item["args"][arg] = val
-
-def search_tags(tags: list, section: dict) -> list:
-    found = []
-    for part in section["data"]:
-        if part["type"] in tags:
-            found.append(part)
-        if part["type"] == "section":
-            _found = search_tags(tags, part)
-            if _found is not None:
-                found += _found
-    return found if len(found) > 0 else None
-
-def search_uid(section: dict, uid: str) -> tuple | None:
-    """
-        section can be section or document
-    """
-    if section["args"]["uid"] == uid:
-        return section, None
-    for part in section["data"]:
-        if part["args"]["uid"] == uid:
-            return part, section
-        elif _is_sec_or_col(part):
-            in_part = search_uid(part, uid)
-            if not in_part is None:
-                return in_part
-    return None
+        spec = specs.get(arg)
+        if spec is None:
+            continue
+        try:
+            val = spec[1](argval)
+        except ValueError:
+            raise ValueError(f"Invalid {arg} for {item.type}: {argval!r}") from None
+        item.set_arg(arg, val)
 
-def search_section(section: dict, ident: int) -> tuple | None:
-    if section["id"] == ident:
+def build_uid_index(doc: DocNode) -> dict[str, tuple]:
+    """
+    Index every item of `doc` with a non-empty uid. Uids used by more than
+    one item are listed on stderr, referring to one is an error (see `_uid_entry`)
+    Params:
+    - doc: document dictionary
+    Returns: dict uid -> (item, parent), the parent is None for `doc`, or
+    None for a duplicate uid
+    """
+    if (prof := _profile.get()) is not None:
+        prof.count_search("build_uid_index")
+    uids = {}
+    duplicates = []
+    stack = [(doc, None)]
+    while stack:
+        part, parent = stack.pop()
+        uid = part.args["uid"]
+        if uid != "":
+            if uid in uids:
+                duplicates.append(uid)
+                uids[uid] = None
+            else:
+                uids[uid] = (part, parent)
+        if _is_sec_or_col(part):
+            # reversed so that items are visited in document order
+            stack.extend((child, part) for child in reversed(part.data))
+    if duplicates:
+        print(f"Duplicate uids: {', '.join(sorted(set(duplicates)))}", file=sys.stderr)
+    return uids
+
+def _uid_entry(uids: dict[str, tuple], uid: str) -> tuple | None:
+    """
+    Returns: (item, parent) of `uid` in `uids` (see `build_uid_index`), None
+    if no item has it
+    Raises: ValueError if several items have it
+    """
+    if uid in uids and uids[uid] is None:
+        raise ValueError(f"Duplicate uid: {uid}")
+    return uids.get(uid)
+
+def search_section(section: DocNode, ident: int) -> tuple | None:
+    if (prof := _profile.get()) is not None:
+        prof.count_search("search_section")
+    if section.id == ident:
         return (section, None)
-    for part in section["data"]:
-        if part["id"] == ident: 
+    for part in section.data:
+        if part.id == ident: 
             return (part, section)
         elif _is_sec_or_col(part):
             in_sec = search_section(part, ident)
@@ -563,308 +1305,530 @@ def search_section(section: dict, ident: int) -> tuple | None:
                 return in_sec
     return None
 
-def add_to_doc(itemdesc: dict, doc: dict, last_added: dict | None) -> None:
+def _append_child(parent: DocNode, itemdesc: DocNode, index: Optional[dict[int, tuple]]) -> None:
+    parent.data.append(itemdesc)
+    if index is not None:
+        index[itemdesc.id] = (itemdesc, parent)
+
+def add_to_doc(
+        itemdesc: DocNode, 
+        doc: DocNode, 
+        last_added: DocNode | None, 
+        index: Optional[dict[int, tuple]]=None) -> None:
+    """
+    Attach `itemdesc` to `doc` according to the section/column nesting rules
+    Params:
+    - itemdesc: item to add
+    - doc: document dictionary
+    - last_added: previously added item (None if `doc` is empty)
+    - index: id -> (item, parent) of every item in `doc`, updated with `itemdesc`.
+    If left None, the parent of `last_added` is found with `search_section`
+    """
     if last_added is None:
-        doc["data"].append(itemdesc)
+        _append_child(doc, itemdesc, index)
         return
 
-    res = search_section(doc, last_added["id"])
+    if index is None:
+        res = search_section(doc, last_added.id)
+    else:
+        res = index.get(last_added.id)
     if res is None:
-        raise ValueError(f"Object with id {last_added['id']} not found")
+        raise ValueError(f"Object with id {last_added.id} not found")
     _, parent = res
     if _is_sec(itemdesc):
         # if new item is section, append new section to doc
-        doc["data"].append(itemdesc)
+        _append_child(doc, itemdesc, index)
         return
     elif _is_sec_or_col(itemdesc):
         # last_added can either be a section, column or other
         # if new item is column, 
         if _is_sec(last_added): # if last_added is a section: add to last_added
-            last_added["data"].append(itemdesc)
+            _append_child(last_added, itemdesc, index)
         elif _is_sec_or_col(last_added): # if last_added is a column: add to parent
-            parent["data"].append(itemdesc)
+            _append_child(parent, itemdesc, index)
         else: # if last_added is an item:
             if _is_sec(parent): # if parent is section: add to parent
-                parent["data"].append(itemdesc)
+                _append_child(parent, itemdesc, index)
             else: # if parent is a column: add to parent of col
-                _, newparent = search_section(doc, parent["id"])
-                newparent["data"].append(itemdesc)
+                if index is None:
+                    _, newparent = search_section(doc, parent.id)
+                else:
+                    _, newparent = index[parent.id]
+                _append_child(newparent, itemdesc, index)
         return
-    if _is_sec(last_added):
-        last_added["data"].append(itemdesc)
-    elif _is_sec_or_col(last_added):
-        last_added["data"].append(itemdesc)
-        # _, _parent = search_section(doc, last_added["id"])
+    if _is_sec_or_col(last_added):
+        _append_child(last_added, itemdesc, index)
+        # _, _parent = search_section(doc, last_added.id)
     else:
-        parent["data"].append(itemdesc)
+        _append_child(parent, itemdesc, index)
 
-def process_data(datastr: str, doc: dict, last_added_item: dict) -> dict | None:
+def _fill_empty(datastr: str, last_added_item: Optional[DocNode]) -> bool:
     """
-        Returns: created text dict or None
+    Use `datastr` as the data of `last_added_item` if it is a code, list,
+    blockquote or text item declared by a tag and still without data
+    Returns: whether `datastr` was used
     """
-    if (not last_added_item is None 
-        and last_added_item["type"] in ["code", "list", 'bq'] 
-        and last_added_item["data"] == ""):
-        datastr = datastr[1:-1].strip()
-        last_added_item["data"] = datastr
-        return None
-    else:
-        if ((not last_added_item is None) and last_added_item["type"] == "text"
-            and last_added_item["data"] == ""):
-            last_added_item["data"] = datastr
-            return last_added_item
-        else:
-            created = create_doc_item("text", datastr)
-            add_to_doc(created, doc, last_added_item)
-            return created
-
-def apply_text_cmds(text: str, doc: dict) -> str:
-    commands = extract_text_cmds(text)
-    if len(commands) == 0:
-        return text
-    for cdict in commands:
-        match cdict["cmd"]:
-            case "link":
-                link = cdict["arg1"]
-                if len(link) == 0:
-                    raise ValueError(f"Empty link: {cdict}")
-                if link[0] == "#":
-                    sres = search_uid(doc, link[1:])
-                    if sres is None:
-                        raise ValueError(f"Can't find doclink: {link}")
-                    linkdest, _ = sres
-                    link = f"#{linkdest['id']}"
-                _blank = f" target='_blank'" if link[0] != "#" else ""
-                text = text.replace(cdict["string"], 
-                    f"<a class='link' href='{link}'"+
-                    _blank +
-                    f">{cdict['arg2'] if not cdict['arg2'] in ['', None] else link}"+
-                    "</a>")
-            case "bold":
-                text = text.replace(cdict["string"],
-                    f"<strong>{cdict['arg1']}</strong>")
-            case "italic":
-                text = text.replace(cdict["string"],
-                    f"<i>{cdict['arg1']}</i>")
-            case "textcode":
-                text = text.replace(cdict["string"],
-                    "<span class='textcode' style='display:inline'>"+
-                    f"{cdict['arg1'] if (not cdict['arg1'] in ['', None]) else ''}</span>")
-            case "showarg":
-                uid = cdict["arg1"]
-                argname = cdict["arg2"]
-                res = search_uid(doc, uid)
-                if res is None:
-                    raise ValueError(f"uid not found: {uid}")
-                if not argname in res[0]["args"].keys():
-                    raise ValueError(f"Argument {argname} not in {res[0]['type']} (uid {uid})")
-                repl_txt = res[0]['args'][argname]
-                # repl_txt = escape_non_cmds(repl_txt)
-                # repl_txt = apply_text_cmds(repl_txt, doc)
-                if argname == "label":
-                    repl_txt = f"<a class='link' href='#{res[0]['id']}'>{repl_txt}</a>"
-                text = text.replace(cdict["string"],
-                    repl_txt)
-            case "tableofcontents":
-                allheads = search_tags(["header", "subheader", "subsubheader"], doc)
-                
-                list_txt = ""
-                for header in allheads:
-                    if header["args"]["uid"] == "": continue
-                    ind_amt = header["type"].count("sub") + 1
-                    list_txt += "#" * ind_amt + ") \\showarg{"
-                    list_txt += header["args"]["uid"] + "}{label}\n"
-                toc = create_doc_item("list", list_txt)
-                tochead = create_doc_item("subheader")
-                tochead["args"]["label"] = "Table of Contents"
-                tochead["args"]["uid"] = "tableofcontents"
-                text = text.replace(cdict["string"],
-                    _html_from_header(tochead, doc) + _html_from_list(toc, doc)
-                )
-    return text
-
-def restore_command(match):
-    command = match.group(1)
-    arg1 = ht.unescape(match.group(2) or "")
-    arg2 = ht.unescape(match.group(3) or "")
-    
-    if arg2:
-        return f"\\{command}{{{ht.escape(arg1)}}}{{{ht.escape(arg2)}}}"
-    else:
-        return f"\\{command}{{{ht.escape(arg1)}}}"
-        
-def escape_non_cmds(text: str) -> str:
-    pattern = r"\\(\w+)(?:\{([^{}]*)\})?(?:\{([^{}]*)\})?"
-    escaped_text = ht.escape(text)
-
-    return re.sub(pattern, restore_command, escaped_text)
-
-def delete_leading_whitespace(tag: str):
-    pattern = r"\n\s*"
-    return re.sub(pattern, "", tag)
-
-def is_type_tag(text: str) -> bool:
-    global TYPES
-    tagptn = r"^\[[a-zA-Z0-9]+\]$"
-    match = re.match(tagptn, text)
-    if match is None:
+    if last_added_item is None or last_added_item.data != "":
         return False
-    nows = re.sub(r"\s", "", match.string)
-    return nows[1:-1] in [item["type"] for item in TYPES]
+    if last_added_item.type in ["code", "list", 'bq']:
+        last_added_item.data = datastr[1:-1].strip()
+        return True
+    if last_added_item.type == "text":
+        last_added_item.data = datastr
+        return True
+    return False
+
+_LIST_LEVELS = 3
+_LIST_MARKER = r"(\*{1,3}|#{1,3}|-{1,3})"
+_LIST_SPLIT = re.compile(r"(?:\n|\s?|^)" + _LIST_MARKER + r"\)")
+_LIST_INDICATOR = re.compile("^" + _LIST_MARKER + "$")
+
+def _split_list_items(dat: str) -> list[tuple[str, str]]:
+    """
+    Params:
+    - dat: list data, e.g. '#) item\n##) subitem'
+    Returns: list of (indicator, item text)
+    """
+    items = []
+    indicator = ""
+    for sd in _LIST_SPLIT.split(dat):
+        sd = sd.strip()
+        if not sd:
+            continue
+        if _LIST_INDICATOR.match(sd):
+            indicator = sd
+        else:
+            items.append((indicator, sd))
+    return items
 
-def is_args(text: str, last_item: dict[str, Any] = None) -> bool:
-    if last_item is not None:
-        # t_idx = [item["type"] for item in TYPES].index(last_item['type'])
-        arg_keys = last_item['args'].keys()
-    if not text.startswith('[') or not text.endswith(']'):
-        return False
+_INLINE_CMD = re.compile(r"\\(\w+)")
+_INLINE_BRACE = re.compile(r"[{}]")
 
-    content = text[1:-1].strip()
-    if not content:
-        return False
+def _inline_arg_end(text: str, start: int) -> int:
+    """
+    Returns: index after the brace closing the argument opened at `start` - 1,
+    -1 if it is never closed
+    """
+    depth = 1
+    for match in _INLINE_BRACE.finditer(text, start):
+        idx = match.start()
+        if idx > 0 and text[idx - 1] == "\\":
+            continue
+        depth += 1 if match.group() == "{" else -1
+        if depth == 0:
+            return idx + 1
+    return -1
 
+def parse_inline(text: str) -> list:
+    """
+    Parse commands in `text` in one pass. Commands are given in the form
+         *backslash*keyword{arg1}{arg2},
+    where arg1 and arg2 are optional based on the keyword. Arguments of a
+    command are not parsed for commands, escaped braces in them are ignored.
+    Unknown keywords are kept as text.
+    Params:
+    - text: unescaped text
+    Returns: inline AST, list of str (text) and (keyword, arg1, arg2) tuples
+    """
+    ast = []
+    length = len(text)
+    text_start = 0
     i = 0
-    length = len(content)
+    while True:
+        match = _INLINE_CMD.search(text, i)
+        if match is None:
+            break
+        i = match.end()
+        args = []
+        while i < length and text[i] == "{":
+            arg_end = _inline_arg_end(text, i + 1)
+            if arg_end < 0:
+                break
+            args.append(text[i + 1:arg_end - 1].replace(r"\{", "{").replace(r"\}", "}"))
+            i = arg_end
+        if match.group(1) in INLINE_CMDS:
+            if text_start < match.start():
+                ast.append(text[text_start:match.start()])
+            ast.append((
+                match.group(1),
+                args[0] if len(args) > 0 else None,
+                args[1] if len(args) > 1 else None,
+            ))
+            text_start = i
+    if text_start < length:
+        ast.append(text[text_start:])
+    return ast
+
+def _inline_esc(text: str | None, br: bool) -> str:
+    text = _escape(text or "")
+    return text.replace("\n", "<br>") if br else text
+
+def _inline_link(arg1, arg2, doc, uids, br) -> str:
+    if arg1 in ["", None]:
+        raise ValueError(f"Empty link: \\link{{{arg1 or ''}}}{{{arg2 or ''}}}")
+    link = _inline_esc(arg1, br)
+    if arg1[0] == "#":
+        if uids is None:
+            uids = build_uid_index(doc)
+        sres = _uid_entry(uids, arg1[1:])
+        if sres is None:
+            raise ValueError(f"Can't find doclink: {arg1}")
+        linkdest, _ = sres
+        link = f"#{linkdest.id}"
+    _blank = " target='_blank'" if link[0] != "#" else ""
+    return (f"<a class='link' href='{link}'" + _blank
+        + f">{_inline_esc(arg2, br) if not arg2 in ['', None] else link}</a>")
+
+def _inline_bold(arg1, arg2, doc, uids, br) -> str:
+    return f"<strong>{_inline_esc(arg1, br)}</strong>"
+
+def _inline_italic(arg1, arg2, doc, uids, br) -> str:
+    return f"<i>{_inline_esc(arg1, br)}</i>"
+
+def _inline_textcode(arg1, arg2, doc, uids, br) -> str:
+    return ("<span class='textcode' style='display:inline'>"
+        + f"{_inline_esc(arg1, br)}</span>")
+
+def _inline_showarg(arg1, arg2, doc, uids, br) -> str:
+    uid = arg1
+    argname = arg2
+    if uids is None:
+        uids = build_uid_index(doc)
+    res = _uid_entry(uids, uid)
+    if res is None:
+        raise ValueError(f"uid not found: {uid}")
+    if not argname in res[0].args.keys():
+        raise ValueError(f"Argument {argname} not in {res[0].type} (uid {uid})")
+    repl_txt = str(res[0].args[argname])
+    if argname == "label":
+        repl_txt = f"<a class='link' href='#{res[0].id}'>{repl_txt}</a>"
+    return repl_txt
+
+def _headings(doc: DocNode) -> list[tuple[DocNode, str]]:
+    if isinstance(doc, Document):
+        return doc.headings
+    # not built by build_doc_dict, index a copy
+    index = Document(doc.id)
+    index.index_headings(part for part, _ in _walk(doc))
+    return index.headings
+
+def _heading_numbers(doc: DocNode) -> dict[int, str]:
+    if isinstance(doc, Document):
+        return doc.heading_numbers
+    return {item.id: number for item, number in _headings(doc)}
+
+def _walk(section: DocNode) -> Iterator[tuple[DocNode, DocNode | None]]:
+    # (item, parent) of `section` and all items in it, in document order
+    stack = [(section, None)]
+    while stack:
+        part, parent = stack.pop()
+        yield part, parent
+        if _is_sec_or_col(part):
+            stack.extend((child, part) for child in reversed(part.data))
+
+def _inline_tableofcontents(arg1, arg2, doc, uids, br) -> str:
+    """
+    Table of contents of the headings with a uid, of the whole document or,
+    if `arg1` is given, of the section/column with uid `arg1`. The list is
+    rendered once per scope and cached on `doc`.
+
+    Its heading gets the id 'tableofcontents', or 'tableofcontents-<arg1>',
+    with '-2', '-3', ... appended for further tables of the same scope.
+    Headings are numbered among the listed ones, unless a heading of the
+    document is numbered=True: then the numbers are the ones shown on the
+    headings.
+    """
+    scope = arg1 or ""
+    ident = f"tableofcontents-{scope}" if scope else "tableofcontents"
+    if isinstance(doc, Document):
+        uses = doc.toc_uses[scope] = doc.toc_uses.get(scope, 0) + 1
+        if uses > 1:
+            ident += f"-{uses}"
+    tochead = create_doc_item("subheader", ident=ident)
+    tochead.set_arg("label", "Table of Contents")
+    tochead.set_arg("uid", ident)
+    head = _html_from_header(tochead, doc, uids)
+    cache = doc.toc_cache if isinstance(doc, Document) else {}
+    html = cache.get(scope)
+    if html is not None:
+        return head + html
+
+    headings = _headings(doc)
+    if scope:
+        if uids is None:
+            uids = build_uid_index(doc)
+        res = _uid_entry(uids, scope)
+        if res is None:
+            raise ValueError(f"uid not found: {scope}")
+        in_scope = {part.id for part, _ in _walk(res[0])}
+        headings = [(item, number) for item, number in headings if item.id in in_scope]
+    headings = [(item, number) for item, number in headings if item.args["uid"] != ""]
+    if not any(item.args["numbered"] for item, _ in _headings(doc)):
+        items = [item for item, _ in headings]
+        headings = list(zip(items, _outline_numbers(items)))
+
+    toc = create_doc_item("list", ident=f"{ident}-list")
+    # same layout as a list of '#) \showarg{uid}{label}' items
+    lvloffset, baseoffset = toc.args["lvloffset"], toc.args["baseoffset"]
+    lines = []
+    for item, number in headings:
+        prespace = " " * (lvloffset * (number.count(".")) + baseoffset)
+        lines.append(f"{prespace}{number} <a class='link' href='#{item.id}'>{item.args['label']}</a>")
+    html = f"<pre class='list {toc.args['class']}' style='{_style_html_from_argdict(toc.args)}'>"
+    html += "<br>".join(lines) + "</pre>"
+    cache[scope] = html
+    return head + html
+
+# keyword -> handler(arg1, arg2, doc, uids, br) returning HTML
+INLINE_CMDS = {
+    "link": _inline_link,
+    "bold": _inline_bold,
+    "italic": _inline_italic,
+    "textcode": _inline_textcode,
+    "showarg": _inline_showarg,
+    "tableofcontents": _inline_tableofcontents,
+}
+
+def render_inline(
+        ast: list, 
+        doc: DocNode, 
+        uids: Optional[dict[str, tuple]]=None, 
+        br: bool=False) -> str:
+    """
+    Params:
+    - ast: inline AST from `parse_inline`
+    - doc: document dictionary
+    - uids: uid index of `doc` (see `build_uid_index`)
+    - br: replace newlines with <br>
+    Returns: HTML str
+    """
+    html = []
+    for node in ast:
+        if isinstance(node, str):
+            html.append(_inline_esc(node, br))
+        else:
+            cmd, arg1, arg2 = node
+            html.append(INLINE_CMDS[cmd](arg1, arg2, doc, uids, br))
+    return "".join(html)
+
+# fields holding inline text, per type
+_INLINE_FIELDS = {
+    "text": ("data",),
+    "list": ("data",),
+    "header": ("label",),
+    "subheader": ("label",),
+    "subsubheader": ("label",),
+    "img": ("caption",),
+}
+
+def _parse_inline_field(part: DocNode, key: str):
+    if key != "data":
+        return parse_inline(part.args[key])
+    if part.type == "list":
+        return [(ind, parse_inline(txt)) for ind, txt in _split_list_items(part.data)]
+    return parse_inline(part.data)
+
+def parse_item_inline(part: DocNode) -> None:
+    """
+    Store the inline AST of `part`'s text fields as `part.inline`.
+    Lists store a list of (indicator, AST) per item.
+    Params:
+    - part: item dictionary
+    """
+    fields = _INLINE_FIELDS.get(part.type)
+    if fields is not None:
+        part.inline = {key: _parse_inline_field(part, key) for key in fields}
 
-    while i < length:
-        # Skip whitespace
-        while i < length and content[i].isspace():
-            i += 1
-
-        # Extract key
-        key_start = i
-        while i < length and (content[i].isalnum() or content[i] == '_'
-                              or content[i] == '-'):
-            i += 1
-        key = content[key_start:i].strip()
-        if not key or (last_item is not None and not key in arg_keys):
-            return False
-
-        # Skip whitespace and expect '='
-        while i < length and content[i].isspace():
-            i += 1
-        if i >= length or content[i] != '=':
-            return False
-        i += 1
-
-        # Skip whitespace before value
-        while i < length and content[i].isspace():
-            i += 1
-
-        # Extract value until a comma that is likely followed by another key=
-        value_start = i
-        while i < length:
-            if content[i] == ',':
-                # Peek ahead to see if it's followed by a valid key=
-                j = i + 1
-                while j < length and content[j].isspace():
-                    j += 1
-                k = j
-                while k < length and (content[k].isalnum() or content[k] == '_'
-                                      or content[k] == '-'):
-                    k += 1
-                while k < length and content[k].isspace():
-                    k += 1
-                if k < length and content[k] == '=':
-                    break
-            i += 1
+def _inline_of(part: DocNode, key: str):
+    """
+    Returns: inline AST of `part`'s `key` field, parsed here if `part` was not
+    built by `build_doc_dict`
+    """
+    inline = part.inline
+    if inline is not None and key in inline:
+        return inline[key]
+    return _parse_inline_field(part, key)
+
+_LEADING_WS = re.compile(r"\n\s*")
 
-        if value_start == i:
-            return False  # Empty value
+def delete_leading_whitespace(tag: str):
+    return _LEADING_WS.sub("", tag)
 
-        # Skip past comma
-        if i < length and content[i] == ',':
-            i += 1
+_TYPE_TAG = re.compile(r"^\[([a-zA-Z0-9]+)\]$")
+_ARG_KEY = re.compile(r"\s*([\w-]*)\s*=\s*")
+# a comma followed by another key= ends a value
+_ARG_SEP = re.compile(r",(?=\s*[\w-]*\s*=)")
 
-    return True
+def is_type_tag(text: str) -> bool:
+    match = _TYPE_TAG.match(text)
+    return match is not None and match.group(1) in SCHEMA
 
-def parse_args(text: str) -> dict | None:
+def lex_args(text: str, last_item: Optional[DocNode] = None) -> dict[str, str] | None:
+    """
+    Validate and parse an args block in one pass.
+    Params:
+    - text: args block, e.g. '[label=Title, uid=title]'
+    - last_item: if given, keys must be args of its type
+    Returns: dict arg -> value string, None if `text` is not a valid args block
+    """
     if not text.startswith('[') or not text.endswith(']'):
         return None
-
     content = text[1:-1].strip()
+    if not content:
+        return None
+    arg_keys = SCHEMA[last_item.type] if last_item is not None else None
+
     result = {}
     i = 0
     length = len(content)
-
     while i < length:
-        # Skip whitespace
-        while i < length and content[i].isspace():
-            i += 1
-        
-        # Extract key
-        key_start = i
-        while i < length and content[i] != '=':
-            i += 1
-        key = content[key_start:i].strip()
-
-        # Skip '=' and surrounding spaces
-        i += 1
-        while i < length and content[i].isspace():
-            i += 1
-
-        # Extract value
-        value_start = i
-        while i < length:
-            if content[i] == ',':
-                # Check if the comma is part of a key-value separator
-                # Look ahead to see if this comma is followed by a key=
-                j = i + 1
-                while j < length and content[j].isspace():
-                    j += 1
-                if j < length and '=' in content[j:]:
-                    break
-            i += 1
-        value = content[value_start:i].strip()
+        match = _ARG_KEY.match(content, i)
+        if match is None or not match.group(1):
+            return None
+        key = match.group(1)
+        if arg_keys is not None and not key in arg_keys:
+            return None
+        value_start = match.end()
+        sep = _ARG_SEP.search(content, value_start)
+        value_end = sep.start() if sep is not None else length
+        if value_end == value_start:
+            return None  # Empty value
+        result[key] = content[value_start:value_end].strip()
+        i = value_end + 1
+    return result
 
-        result[key] = value
+def is_args(text: str, last_item: Optional[DocNode] = None) -> bool:
+    return lex_args(text, last_item) is not None
 
-        # Skip the comma and continue
-        i += 1
+def parse_args(text: str) -> dict | None:
+    return lex_args(text)
 
-    return result
+# plain text runs, whitespace runs, or a single char that matters to the lexer
+_LEX_TOKEN = re.compile(r"[^\s\\\[\]{}]+|\s+|[\\\[\]{}]")
+
+def iter_top_level_tags(source: str | Iterable[str]) -> Iterator[str]:
+    """
+    Single pass lexer behind `extract_top_level_tags`. Whitespace between
+    top-level tags and around them is dropped while the tags are split out,
+    and parts are joined from slices of `source` only once they are complete.
+    Params:
+    - source: wbuild code, or an iterable of consecutive chunks of it
+    Returns: generator of stripped, non-empty parts
+    """
+    if isinstance(source, str):
+        # the lookbehind of a leading whitespace run wraps around the text
+        hist = ("\0\0" + source)[-2:]
+        chunks = (source,)
+    else:
+        hist = "\0\0"
+        chunks = source
 
-def format_whitespaces(text: str) -> str:
+    # whitespace normalisation state
     open_bracks = 0
     escape = False
-    esc_idx = 0
-    indices_to_rm = [] # tuples (min, max excluded)
-    whitespace_streak = 0
-    for c_idx, char in enumerate(text):
-        if char == "\\" and not escape:
-            escape = True
-            esc_idx = c_idx
-
-        if not escape and char == "[":
-            open_bracks += 1
-            if open_bracks == 1 and whitespace_streak > 0 and c_idx > 0:
-                idx_range = (esc_idx, c_idx)
-                indices_to_rm.append(idx_range)
-
-        if not escape and char == "]":
-            open_bracks = max(0, open_bracks - 1)
-
-        if re.match(r"\s", str(char)):
-            if whitespace_streak == 0:
-                esc_idx = c_idx
-            whitespace_streak += 1
-        else:
-            # non whitespace
-            if (char in "[]" and escape) or not char in "[]":
-                if (whitespace_streak > 0 and text[esc_idx - 1] in "[]" 
-                    and text[esc_idx - 2] != "\\") and open_bracks == 0:
-                    indices_to_rm.append((esc_idx, c_idx))
-            whitespace_streak = 0
-
-        if esc_idx == c_idx - 1:
-            escape = False
-    for idx_range in reversed(indices_to_rm):
-        text = text[:idx_range[0]] + text[idx_range[1]:]
-    return text
-
-def rm_empties(strarrs: list) -> list:
-    return [string for string in strarrs if not re.match(r'^\s?$', string)]
+    esc_idx = 0 # index of last backslash or start of whitespace run
+    streak = 0
+    ws_before = hist # two chars preceding the current whitespace run
+    pending_ws = [] # current whitespace run, dropped or kept on its end
+
+    # tag splitting state
+    buffer = []
+    tag_depth = 0
+    curly_depth = 0
+    pending_bs = False
+
+    def split(piece: str) -> str | None:
+        # feed kept text to the splitter, returns a finished part if any
+        nonlocal buffer, tag_depth, curly_depth, pending_bs
+        if pending_bs:
+            pending_bs = False
+            if piece in "[]{}":
+                # escaped bracket: keep the bracket, drop the backslash
+                buffer.append(piece)
+                return None
+            buffer.append("\\")
+        if len(piece) > 1 or not piece in "\\[]{}":
+            buffer.append(piece)
+        elif piece == "\\":
+            pending_bs = True
+        elif piece == "{":
+            curly_depth += 1
+            buffer.append(piece)
+        elif piece == "}":
+            if curly_depth:
+                curly_depth -= 1
+                buffer.append(piece)
+        elif curly_depth:
+            buffer.append(piece)
+        elif piece == "[":
+            part = None
+            if not tag_depth:
+                part = "".join(buffer).strip() or None
+                buffer = []
+            tag_depth += 1
+            buffer.append(piece)
+            return part
+        elif tag_depth:
+            buffer.append(piece)
+            tag_depth -= 1
+            if not tag_depth:
+                part = "".join(buffer).strip()
+                buffer = []
+                return part
+        return None
 
+    pos = 0
+    for chunk in chunks:
+        for match in _LEX_TOKEN.finditer(chunk):
+            tok = match.group()
+            c_idx = pos + match.start()
+            char = tok[0]
+            if char.isspace():
+                if streak == 0:
+                    esc_idx = c_idx
+                    ws_before = hist
+                streak += len(tok)
+                # an escape lasts until the char after esc_idx
+                if esc_idx == c_idx - 1 or (len(tok) > 1 and esc_idx == c_idx):
+                    escape = False
+                pending_ws.append(tok)
+            else:
+                if char == "\\" and not escape:
+                    escape = True
+                    esc_idx = c_idx
+                drop_ws = False
+                if not escape and char == "[":
+                    open_bracks += 1
+                    # whitespace before a top-level tag
+                    drop_ws = open_bracks == 1 and streak > 0
+                if not escape and char == "]":
+                    open_bracks = max(0, open_bracks - 1)
+                if ((escape or not char in "[]") and streak > 0 and esc_idx != c_idx
+                    and ws_before[1] in "[]" and ws_before[0] != "\\" and open_bracks == 0):
+                    # whitespace after a tag, outside of tags
+                    drop_ws = True
+                streak = 0
+                if esc_idx == c_idx - 1:
+                    escape = False
+
+                if pending_ws:
+                    if not drop_ws:
+                        for ws in pending_ws:
+                            split(ws)
+                    pending_ws = []
+                part = split(tok)
+                if part:
+                    yield part
+            hist = tok[-2:] if len(tok) > 1 else hist[-1] + tok
+        pos += len(chunk)
+
+    for ws in pending_ws:
+        split(ws)
+    if pending_bs:
+        buffer.append("\\")
+    part = "".join(buffer).strip()
+    if part:
+        yield part
 
 def extract_top_level_tags(text):
     """
@@ -872,164 +1836,1845 @@ def extract_top_level_tags(text):
     A "top-level tag" is a tag that is not nested inside another.
     Ignores tags inside curly braces {}.
     """
-    result = []
-    buffer = ""
-    tag_stack = []
-    curly_stack = []
-    tag_id = 0
-    text = format_whitespaces(text)
-    length = len(text)
+    return list(iter_top_level_tags(text))
 
-    while tag_id < length:
-        char = text[tag_id]
-        # Handle escaped brackets (e.g., \[ or \])
-        if char == "\\" and tag_id + 1 < length and text[tag_id + 1] in "[]{}":
-            buffer += text[tag_id + 1]  # Add the escaped character
-            tag_id += 2
+def find_pages(src: str, exclude: Iterable[str]=()) -> list[tuple[str, str]]:
+    """
+    Params:
+    - src: directory (searched recursively for .txt files) or glob pattern
+    - exclude: paths to leave out, e.g. the footer file
+    Returns: sorted list of (input path, output path relative to the output dir)
+    """
+    exclude = {os.path.abspath(path) for path in exclude}
+    if os.path.isdir(src):
+        root = src
+        paths = [
+            os.path.join(dirpath, fname)
+            for dirpath, _, fnames in os.walk(src)
+            for fname in fnames if fname.endswith(".txt")
+        ]
+    else:
+        import glob
+        paths = [path for path in glob.glob(src, recursive=True) if os.path.isfile(path)]
+        dirs = [os.path.dirname(os.path.abspath(path)) for path in paths]
+        root = os.path.commonpath(dirs) if dirs else ""
+    pages = []
+    for path in sorted(paths):
+        if os.path.abspath(path) in exclude:
             continue
-        if char == "{":
-            curly_stack.append(tag_id)
-            buffer += char
-        elif char == "}":
-            if curly_stack:
-                curly_stack.pop()
-                buffer += char
-        # Detect an opening bracket for a new tag, but only if NOT inside {}
-        elif char == "[" and not curly_stack:
-            if not tag_stack:  # If no open tags, flush buffer to results
-                if buffer.strip(): 
-                    result.append(buffer.strip())
-                buffer = ""
-
-            tag_stack.append(tag_id)
-            buffer += char
-        # Detect a closing bracket, possibly ending a top-level tag, but only if NOT inside {}
-        elif char == "]" and not curly_stack:
-            if tag_stack:
-                buffer += char
-                tag_stack.pop()
-                if not tag_stack:
-                    result.append(buffer.strip())
-                    buffer = ""
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+        pages.append((path, os.path.splitext(rel)[0] + ".html"))
+    return pages
+
+def image_size(path: str) -> tuple[int, int] | None:
+    """
+    Read the dimensions of a PNG, GIF, JPEG, WebP or BMP image from its header
+    Returns: (width, height), None if the format is not recognized
+    """
+    with open(path, "rb") as f:
+        head = f.read(30)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) == 30:
+            return _webp_size(head)
+        if head.startswith(b"BM") and len(head) >= 26:
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)
+        if head.startswith(b"\xff\xd8"):
+            f.seek(2)
+            return _jpeg_size(f)
+    return None
+
+def _webp_size(head: bytes) -> tuple[int, int] | None:
+    chunk = head[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", head[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b"VP8L":
+        bits = int.from_bytes(head[21:25], "little")
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b"VP8X":
+        return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+    return None
+
+def _jpeg_size(f) -> tuple[int, int] | None:
+    # walk the segments up to the first start of frame
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            continue  # no length
+        if marker in (0xd9, 0xda):
+            return None  # end of image or scan data before a frame
+        seg = f.read(2)
+        if len(seg) < 2:
+            return None
+        length = struct.unpack(">H", seg)[0]
+        if 0xc0 <= marker <= 0xcf and not marker in (0xc4, 0xc8, 0xcc):
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">HH", frame[1:5])
+            return width, height
+        f.seek(length - 2, 1)
+
+IMAGE_CACHE_FILE = ".wbuild-images.json"
+IMAGE_CACHE_VERSION = 1
+# image formats Pillow writes srcset variants for
+_VARIANT_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+# absolute path -> {'stat', 'sha256', 'width', 'height'} of images read by
+# image_info, shared by the threads of this process
+_images = {}
+_images_lock = threading.Lock()
+# file _images is loaded from and saved to, see use_image_cache
+_image_cache_path = None
+_image_cache_dirty = False
+
+def use_image_cache(path: Optional[str]) -> None:
+    """
+    Load image sizes and hashes saved at `path` by `save_image_cache`, so that
+    unchanged images are not read again. Entries are checked against the
+    image's mtime and size before use.
+    """
+    global _image_cache_path
+    _image_cache_path = path
+    if path is None:
+        return
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return
+    if cache.get("version") == IMAGE_CACHE_VERSION:
+        with _images_lock:
+            for img_path, info in cache.get("images", {}).items():
+                _images.setdefault(img_path, info)
+
+def save_image_cache() -> None:
+    """
+    Save the image cache to the file given to `use_image_cache`, merged with
+    its current contents (other processes may save to it as well)
+    """
+    global _image_cache_dirty
+    if _image_cache_path is None or not _image_cache_dirty:
+        return
+    with _images_lock:
+        images = dict(_images)
+        _image_cache_dirty = False
+    try:
+        with open(_image_cache_path) as f:
+            cache = json.load(f)
+        if cache.get("version") == IMAGE_CACHE_VERSION:
+            images = {**cache.get("images", {}), **images}
+    except (OSError, ValueError):
+        pass
+    os.makedirs(os.path.dirname(os.path.abspath(_image_cache_path)), exist_ok=True)
+    tmp = f"{_image_cache_path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": IMAGE_CACHE_VERSION, "images": images}, f, indent=1, sort_keys=True)
+    os.replace(tmp, _image_cache_path)
+
+def image_info(path: str) -> dict[str, Any] | None:
+    """
+    Returns: {'width', 'height', 'sha256', 'stat'} of the image at `path`,
+    None if it can't be read or its format is not known. Cached by mtime
+    and size.
+    """
+    global _image_cache_dirty
+    path = os.path.abspath(path)
+    key = _stat_key(path)
+    if key is None:
+        return None
+    with _images_lock:
+        cached = _images.get(path)
+    if cached is not None and tuple(cached["stat"]) == key:
+        return cached
+    try:
+        size = image_size(path)
+        digest = _file_hash(path) if size is not None else ""
+    except (OSError, struct.error):
+        return None
+    if size is None:
+        return None
+    info = {"stat": list(key), "sha256": digest, "width": size[0], "height": size[1]}
+    with _images_lock:
+        _images[path] = info
+        _image_cache_dirty = True
+    return info
+
+_pil_warned = False
+
+def _pil_image():
+    # PIL.Image if Pillow is installed, it's only needed for srcset variants
+    global _pil_warned
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pil_warned:
+            _pil_warned = True
+            print("Pillow is not installed, images get no srcset variants", file=sys.stderr)
+        return None
+    return Image
+
+def _image_variants(path: str, info: dict[str, Any], widths: Iterable[int], dest_dirs: list[str]) -> list[tuple[int, str]]:
+    """
+    Downscaled copies of the image at `path` for a srcset, named after its
+    hash so that existing copies are reused
+    Params:
+    - widths: widths of the copies, those not below the image's are skipped
+    - dest_dirs: directories to write the copies to
+    Returns: (width, file name) per copy
+    """
+    stem, ext = os.path.splitext(os.path.basename(path))
+    if not ext.lower() in _VARIANT_EXTS:
+        return []
+    variants = [
+        (width, f"{stem}.{info['sha256'][:8]}.{width}w{ext}") 
+        for width in sorted(set(widths)) if 0 < width < info["width"]
+    ]
+    missing = [
+        (width, os.path.join(dest, name)) for width, name in variants for dest in dest_dirs 
+        if not os.path.exists(os.path.join(dest, name))
+    ]
+    if missing:
+        Image = _pil_image()
+        if Image is None:
+            return []
+        with Image.open(path) as im:
+            for width, dest in missing:
+                height = max(1, round(info["height"] * width / info["width"]))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+                im.resize((width, height), Image.LANCZOS).save(tmp, format=im.format)
+                os.replace(tmp, dest)
+    return variants
+
+def prepare_images(
+        doc: Document, 
+        items: Iterable[DocNode], 
+        page_dirs: list[str], 
+        src_dir: Optional[str]=None, 
+        widths: Iterable[int]=()) -> None:
+    """
+    Read the sizes of the local images among `items`, and make their srcset
+    variants if `widths` are given, in a thread pool. Results are stored in
+    `doc.images` by src for `_html_from_img`.
+    Params:
+    - doc: document of `items`
+    - items: items to look for [img] in
+    - page_dirs: directories of the pages `doc` is written to. `src` is
+    resolved against the first, variants are written to each
+    - src_dir: directory of the wbuild file, `src` is resolved against it if
+    the image is not found next to the page
+    - widths: srcset variant widths
+    """
+    srcs = {
+        item.args["src"] for item in items 
+        if item.type == "img" and item.args["src"] and not _URL_SCHEME.match(item.args["src"])
+    }
+    srcs = [src for src in srcs if not src in doc.images]
+    if not srcs:
+        return
+    widths = tuple(widths)
+    bases = [page_dirs[0]] + ([src_dir] if src_dir else [])
+
+    def process(src):
+        for base in bases:
+            path = os.path.join(base, src)
+            info = image_info(path)
+            if info is not None:
+                break
         else:
-            buffer += char
-        tag_id += 1
-    if buffer.strip():
-        result.append(buffer.strip())
+            return None
+        srcset = ""
+        if widths:
+            dests = [os.path.dirname(os.path.join(page_dir, src)) for page_dir in page_dirs]
+            variants = _image_variants(path, info, widths, dests)
+            if variants:
+                url_dir = posixpath.dirname(src)
+                srcset = ", ".join(f"{posixpath.join(url_dir, name)} {width}w" for width, name in variants)
+                srcset += f", {src} {info['width']}w"
+        return {"width": info["width"], "height": info["height"], "srcset": srcset}
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(srcs), 8)) as pool:
+        for src, res in zip(srcs, pool.map(process, srcs)):
+            if res is not None:
+                doc.images[src] = res
+
+TREE_FORMAT = "wbuild-tree"
+TREE_VERSION = 1
+
+def _encode_node(part: DocNode) -> list:
+    # [type, id, args (None if default), data, inline]
+    return [
+        part.type,
+        part.id,
+        None if part.args is _TYPE_ARGS[part.type] else part.args,
+        [_encode_node(child) for child in part.data] if isinstance(part.data, list) else part.data,
+        part.inline,
+    ]
 
-    result = rm_empties(result)
-    return result
+def _decode_ast(ast: list) -> list:
+    return [node if isinstance(node, str) else tuple(node) for node in ast]
+
+def _decode_node(enc: list, node: Optional[DocNode]=None) -> DocNode:
+    type, ident, args, data, inline = enc
+    if node is None:
+        node = DocNode(type, ident, data, args)
+    elif args is not None:
+        node.args = args
+    if isinstance(data, list):
+        node.data = [_decode_node(child) for child in data]
+    if inline is not None:
+        node.inline = {
+            key: [(ind, _decode_ast(ast)) for ind, ast in val] if type == "list" and key == "data"
+                else _decode_ast(val)
+            for key, val in inline.items()
+        }
+    return node
+
+def source_hash(txt: str) -> str:
+    import hashlib
+    return hashlib.sha256(txt.encode()).hexdigest()
 
-def extract_text_cmds(text):
+def save_tree(doc: Document, path: str, src_hash: str="") -> None:
+    """
+    Save a built document to `path` as JSON, including the parsed inline
+    text, so that `load_tree` can skip tokenizing and tree building.
+    Params:
+    - doc: document from `build_doc_dict`
+    - path: tree file path
+    - src_hash: `source_hash` of the code `doc` was built from, checked by `load_tree`
     """
-        Captures commands in the form
-             *backslash*keyword{arg1}{arg2},
-        where arg1 and arg2 are optional based on the keyword.
-        Nested braches are disallowed, but escaped ones are ignored.
+    tree = {
+        "format": TREE_FORMAT,
+        "version": TREE_VERSION,
+        "source": src_hash,
+        "doc": _encode_node(doc),
+    }
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(tree, f, separators=(",", ":"))
+    os.replace(tmp, path)
 
-        Keywords:
-         link{url}{text: optional}
-         bold{text}
-         italic{text}
-         textcode{text}
-         showargs{uid}{argname}
+def load_tree(path: str, src_hash: Optional[str]=None) -> Document:
+    """
+    Load a document saved by `save_tree`
+    Params:
+    - path: tree file path
+    - src_hash: if given, the `source_hash` the tree must have been built from
+    Returns: document, as returned by `build_doc_dict`
+    Raises: ValueError if the file is not a tree of this version or was
+    built from other code
+    """
+    with _stage("read"), open(path) as f:
+        tree = json.load(f)
+    if not isinstance(tree, dict) or tree.get("format") != TREE_FORMAT:
+        raise ValueError(f"Not a wbuild tree file: {path}")
+    if tree.get("version") != TREE_VERSION:
+        raise ValueError(f"Tree file version {tree.get('version')} is not supported (expected {TREE_VERSION}): {path}")
+    if src_hash is not None and tree.get("source") != src_hash:
+        raise ValueError(f"Tree file was built from different code: {path}")
+    with _stage("tree"):
+        enc = tree["doc"]
+        doc = _decode_node(enc, Document(enc[1]))
+        doc.index_headings(part for part, _ in _walk(doc))
+    return doc
 
-        Returns a list of dicts with keys:
-            - cmd: The command keyword.
-            - arg1: The first argument.
-            - arg2: The second argument.
-            - string: The matched substring.
+def build_doc_cached(txt: str, cache_dir: str, first_id: int=0) -> Document:
     """
-    commands = []
-    pattern = r"\\(\w+)"
-    i = 0
-    length = len(text)
+    `build_doc_dict` with the trees kept in `cache_dir`, keyed by the hash
+    of `txt`
+    """
+    src_hash = source_hash(f"{first_id}:{txt}")
+    path = os.path.join(cache_dir, f"{src_hash[:32]}.tree.json")
+    try:
+        return load_tree(path, src_hash)
+    except (OSError, ValueError):
+        pass
+    doc = build_doc_dict(txt, first_id)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_tree(doc, path, src_hash)
+    return doc
 
-    while i < length:
-        match = re.search(pattern, text[i:])
-        if not match:
-            break
+class Profile:
+    """
+    Timings of one build, collected while it is set as the current context's
+    `_profile` (see `profiling`): wall time and peak traced memory per stage,
+    render time per item type and the number of tree search calls.
+
+    Stages are 'read', 'tokenize', 'tree', 'render', 'footer' and 'write',
+    or 'index', 'stream' and 'footer' for `stream_page`.
+    A stage entered while another is active is counted as part of the outer
+    one, e.g. parsing the footer is part of 'footer'.
+    """
+    def __init__(self, trace_memory: bool=True):
+        self.stages = {}
+        self.render = {}
+        self.searches = {}
+        self.trace_memory = trace_memory
+        self._current = None
+        self._started_tracing = False
+
+    def start(self) -> None:
+        import tracemalloc
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self) -> None:
+        import tracemalloc
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self._current is not None:
+            yield
+            return
+        import tracemalloc
+        self._current = name
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self.stages.setdefault(name, {"seconds": 0.0, "peak_bytes": 0})
+            stats["seconds"] += elapsed
+            if tracing:
+                stats["peak_bytes"] = max(stats["peak_bytes"], tracemalloc.get_traced_memory()[1])
+            self._current = None
+
+    def add_render(self, type: str, seconds: float) -> None:
+        stats = self.render.get(type)
+        if stats is None:
+            stats = self.render[type] = {"count": 0, "seconds": 0.0}
+        stats["count"] += 1
+        stats["seconds"] += seconds
+
+    def count_search(self, name: str) -> None:
+        self.searches[name] = self.searches.get(name, 0) + 1
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "seconds": sum(stats["seconds"] for stats in self.stages.values()),
+            "stages": self.stages,
+            "render": self.render,
+            "searches": self.searches,
+        }
 
-        cmd_start = i + match.start()
-        cmd_end = i + match.end()
-        cmd = match.group(1)
+def format_profile(report: dict[str, Any], name: str="") -> str:
+    """
+    Params:
+    - report: `Profile.to_dict` result
+    - name: page name for the first line
+    Returns: human readable report
+    """
+    lines = [f"Profile{' of ' + name if name else ''}: {report['seconds'] * 1000:.1f}ms"]
+    for stage, stats in report["stages"].items():
+        lines.append(f"  {stage:<10}{stats['seconds'] * 1000:9.1f}ms  peak {stats['peak_bytes'] / 2**20:7.2f}MB")
+    if report["render"]:
+        lines.append("  render by type:")
+        by_time = sorted(report["render"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+        for type, stats in by_time:
+            lines.append(f"    {type:<14}{stats['count']:7} items {stats['seconds'] * 1000:9.1f}ms")
+    searches = ", ".join(f"{fn} {n}" for fn, n in sorted(report["searches"].items())) or "none"
+    lines.append(f"  search calls: {searches}")
+    return "\n".join(lines)
+
+# profile of the builds in this thread or task, see `profiling`
+_profile: contextvars.ContextVar[Optional[Profile]] = contextvars.ContextVar("wbuild_profile", default=None)
+
+@contextlib.contextmanager
+def profiling(trace_memory: bool=True) -> Iterator[Profile]:
+    """
+    Profile the builds done in this block by this thread (or asyncio task),
+    builds in other threads are not recorded
+    Params:
+    - trace_memory: also record peak memory per stage with tracemalloc,
+    which slows the build down
+    """
+    prof = Profile(trace_memory)
+    prof.start()
+    token = _profile.set(prof)
+    try:
+        yield prof
+    finally:
+        _profile.reset(token)
+        prof.stop()
+
+def _stage(name: str):
+    prof = _profile.get()
+    return prof.stage(name) if prof is not None else contextlib.nullcontext()
+
+class Builder:
+    """
+    Renders wbuild code to pages with fixed options, e.g. inside a web app.
+    The style sheet, scripts and footer are read and rendered once here;
+    `build` and `build_to` then only parse and render the document, with no
+    file I/O and no shared mutable state, so any number of threads may call
+    them at once (asyncio code can use `asyncio.to_thread`).
+    Params:
+    - mode: page theme
+    - title, favicon: see `write_html`
+    - footer: footer file path or document (see `load_footer`), optional
+    - asset_urls: link the style sheet and scripts at these URLs instead of
+    inlining them, see `asset_urls`
+    - minify: see `minify_page`
+    - critical_css: inline only the style rules each page may use, see `prune_css`
+    """
+    def __init__(
+            self, 
+            mode: str='dark', 
+            title: str='Wbuild Page', 
+            favicon: str='', 
+            footer: Optional[str | DocNode]=None, 
+            asset_urls: Optional[dict[str, str]]=None, 
+            minify: bool=False, 
+            critical_css: bool=False):
+        if isinstance(footer, str):
+            footer = load_footer(footer)
+        self.mode = mode
+        self.title = title
+        self.favicon = favicon
+        self.asset_urls = asset_urls
+        self.minify = minify
+        self.has_footer = footer is not None
+        self._head = _page_head(mode, self.has_footer, title, favicon, asset_urls)
+        self._tail = [_page_scripts(mode, asset_urls)]
+        if footer is not None:
+            write_footer(footer, self._tail)
+        self._tail.append('</div></body></html>')
+        self._css = CssIndex(_read_asset(_style_path())) if critical_css and asset_urls is None else None
+
+    def build(self, text: str) -> str:
+        """
+        Returns: page HTML of the wbuild code `text`
+        """
+        page = []
+        self.build_to(text, page)
+        return "".join(page)
+
+    def build_to(self, text: str, out) -> None:
+        """
+        Write the page of the wbuild code `text` to `out`, a file-like
+        object, list sink or callable (see `_writer`)
+        """
+        doc = build_doc_dict(text)
+        write = _writer(out)
+        if not self.minify and self._css is None:
+            write(self._head)
+            write_container(doc, write, self.mode)
+            for fragment in self._tail:
+                write(fragment)
+            return
+        page = [self._head]
+        write_container(doc, page, self.mode)
+        page += self._tail
+        if self._css is not None:
+            style_sheet = self._css.prune(used_selectors(page))
+            page[0] = _page_head(self.mode, self.has_footer, self.title, self.favicon, None, style_sheet)
+        if self.minify:
+            page = minify_page(page)
+        for fragment in page:
+            write(fragment)
+
+def build_page(
+        inpath: str, 
+        outpath: str, 
+        mode: str | list[str]='dark', 
+        title='Wbuild Page', 
+        favicon='', 
+        footer: Optional[DocNode]=None,
+        assets_dir: Optional[str]=None,
+        theme_root: Optional[str]=None,
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search_index: Optional[str]=None,
+        search_shard: Optional[str]=None) -> None:
+    """
+    Build the wbuild file at `inpath` and write the page to `outpath`
+    Params:
+    - inpath: wbuild code path
+    - outpath: HTML output path, parent directories are created
+    - mode: page theme, or list of themes to write a page for each from one
+    parse (see `write_pages`), at `theme_outpath(outpath, mode, theme_root)`
+    - title, favicon, footer: see `write_html`
+    - assets_dir: if given, link the assets written there by `write_assets`
+    instead of inlining them
+    - theme_root: see `theme_outpath`
+    - img_widths: see `prepare_images`
+    - minify: minify the page, see `minify_page`
+    - precompress: also write a gzip copy of the page, see `write_gzip`
+    - critical_css: inline only the style rules the page may use (see
+    `prune_css`), if the assets are inlined
+    - search_index: see `write_html`
+    - search_shard: write the page's search shard (see `search_entries`) to
+    this path
+    """
+    with _stage("read"), open(inpath, "r") as infile:
+        txt = infile.read()
+    doc = build_doc_dict(txt)
+    del txt
+    src_dir = os.path.dirname(os.path.abspath(inpath))
+    if isinstance(mode, str):
+        write_page(doc, outpath, mode, title, favicon, footer, assets_dir, src_dir, img_widths, minify, precompress, 
+            critical_css, search_index)
+    else:
+        outpaths = {m: theme_outpath(outpath, m, theme_root) for m in mode}
+        write_pages(doc, outpaths, title, favicon, footer, assets_dir, src_dir, img_widths, minify, precompress, 
+            critical_css, search_index)
+    if search_shard is not None:
+        with _stage("search"):
+            write_search_shard(doc, search_shard)
+
+def theme_outpath(outpath: str, mode: str, root: Optional[str]=None) -> str:
+    """
+    Output path of the `mode` variant of the page at `outpath`, when several
+    themes are built: `outpath` moved under a directory named `mode` in `root`
+    Params:
+    - root: directory containing `outpath`, defaults to its parent. Site
+    builds use the output directory, so that links between pages still work
+    Returns: e.g. 'out/dark/page.html' for 'out/page.html'
+    """
+    if root is None:
+        root = os.path.dirname(outpath)
+    return os.path.join(root, mode, os.path.relpath(outpath, root))
+
+def _page_outputs(outpath: str, mode: str | list[str], root: Optional[str]=None) -> list[str]:
+    if isinstance(mode, str):
+        return [outpath]
+    return [theme_outpath(outpath, m, root) for m in mode]
+
+def write_pages(
+        doc: DocNode, 
+        outpaths: dict[str, str], 
+        title='Wbuild Page', 
+        favicon='', 
+        footer: Optional[DocNode]=None,
+        assets_dir: Optional[str]=None,
+        src_dir: Optional[str]=None,
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search_index: Optional[str]=None) -> None:
+    """
+    Write a page per theme from one render. The document and footer are
+    rendered once without per-item themes, only the page's body carries the
+    theme (the style sheet only themes the body).
+    Params:
+    - doc: document from `build_doc_dict`
+    - outpaths: theme -> output path
+    - title, favicon, footer, assets_dir, minify, precompress, critical_css: see `build_page`
+    - src_dir, img_widths: see `prepare_images`
+    - search_index: see `write_html`, the same for every theme
+    """
+    with _stage("images"):
+        prepare_images(doc, (item for item, _ in _walk(doc)), _page_dirs(outpaths.values()), src_dir, img_widths)
+    body = []
+    with _stage("render"):
+        write_container(doc, body, None)
+    foot = []
+    if footer is not None:
+        with _stage("footer"):
+            write_footer(footer, foot)
+    with _stage("write"):
+        for mode, outpath in outpaths.items():
+            outdir = os.path.dirname(outpath)
+            if outdir:
+                os.makedirs(outdir, exist_ok=True)
+            urls = asset_urls(assets_dir, os.path.dirname(os.path.abspath(outpath))) if assets_dir else None
+            page = [
+                _page_head(mode, footer is not None, title, favicon, urls), 
+                *body, 
+                _page_scripts(mode, urls, search_index), 
+                *foot, 
+                '</div></body></html>',
+            ]
+            if critical_css and urls is None:
+                page[0] = _critical_head(page, mode, footer is not None, title, favicon)
+            if minify:
+                page = minify_page(page)
+            with open(outpath, "w") as save_to:
+                save_to.writelines(page)
+            _finish_output(outpath, precompress)
+
+def _page_dirs(outpaths: Iterable[str]) -> list[str]:
+    return [os.path.dirname(os.path.abspath(path)) for path in outpaths]
+
+def _read_chunks(f, size: int=1 << 20) -> Iterator[str]:
+    return iter(lambda: f.read(size), "")
+
+def _skeleton(part: DocNode) -> DocNode | None:
+    # copy of the sections, columns, headings and items with a uid in `part`, without text
+    if _is_sec_or_col(part):
+        children = [skel for skel in map(_skeleton, part.data) if skel is not None]
+        return DocNode(part.type, part.id, children, part.args)
+    if part.type in _HEADING_LEVELS or part.args["uid"] != "":
+        return DocNode(part.type, part.id, "", part.args)
+    return None
 
-        # Check that the match is not part of \word{arg}{arg}
-        before_match = text[:cmd_start].rstrip()
-        after_match = text[cmd_end:].lstrip()
+def index_stream(chunks: Iterable[str], first_id: int=0) -> tuple[Document, dict[str, tuple]]:
+    """
+    First pass of `stream_page`: build the document one top-level item at a
+    time, keeping only what other items refer to (uids for \\link and
+    \\showarg, headings for \\tableofcontents and numbering)
+    Params:
+    - chunks: consecutive chunks of wbuild code
+    - first_id: see `build_doc_dict`
+    Returns: (skeleton document, its uid index), usable as `doc` and `uids`
+    when rendering the items of the full document
+    """
+    skel = Document(first_id)
+    builder = _TreeBuilder(Document(first_id), detach=True)
+
+    def add(part):
+        if part is not None and (part_skel := _skeleton(part)) is not None:
+            skel.data.append(part_skel)
+
+    for part in iter_top_level_tags(chunks):
+        add(builder.feed(part))
+    add(builder.close())
+    skel.index_headings(item for item, _ in _walk(skel))
+    return skel, build_uid_index(skel)
+
+def stream_page(
+        inpath: str, 
+        outpath: str, 
+        mode: str | list[str]='dark', 
+        title='Wbuild Page', 
+        favicon='', 
+        footer: Optional[DocNode]=None,
+        assets_dir: Optional[str]=None,
+        theme_root: Optional[str]=None,
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        chunk_size: int=1 << 20) -> None:
+    """
+    Build the page like `build_page`, with memory bounded by the largest
+    top-level [section] instead of the whole document. `inpath` is read
+    twice in chunks: once to index uids and headings (see `index_stream`),
+    then to render and write each top-level item as soon as it is complete.
+    Params:
+    - minify: minify the page as it is written with `HtmlMinifier`, repeated
+    inline styles are kept as they can't be counted before the head is written.
+    For the same reason the whole style sheet is inlined (no `critical_css`)
+    - chunk_size: characters read at a time
+    - others: see `build_page`
+    """
+    if isinstance(mode, str):
+        outpaths = {mode: outpath}
+    else:
+        outpaths = {m: theme_outpath(outpath, m, theme_root) for m in mode}
+    with _stage("index"), open(inpath, "r") as infile:
+        skel, uids = index_stream(_read_chunks(infile, chunk_size))
+    page_dirs = _page_dirs(outpaths.values())
+    src_dir = os.path.dirname(os.path.abspath(inpath))
+
+    files = {}
+    writes = {}
+    urls = {}
+    try:
+        for m, path in outpaths.items():
+            outdir = os.path.dirname(path)
+            if outdir:
+                os.makedirs(outdir, exist_ok=True)
+            urls[m] = asset_urls(assets_dir, os.path.dirname(os.path.abspath(path))) if assets_dir else None
+            files[m] = open(path, "w")
+            writes[m] = files[m].write
+            if minify:
+                minifier = HtmlMinifier()
+                writes[m] = lambda html, f=files[m], minifier=minifier: f.write(minifier.feed(html))
+            writes[m](_page_head(m, footer is not None, title, favicon, urls[m]))
+            # several themes share theme-neutral HTML, see `write_pages`
+            writes[m](_container_open(skel, m if isinstance(mode, str) else None))
+
+        def emit(top):
+            prepare_images(skel, (item for item, _ in _walk(top)), page_dirs, src_dir, img_widths)
+            if isinstance(mode, str):
+                _write_parts((top,), writes[mode], mode, skel, uids)
+                return
+            html = []
+            _write_parts((top,), html.append, None, skel, uids)
+            for write in writes.values():
+                for fragment in html:
+                    write(fragment)
+
+        with _stage("stream"), open(inpath, "r") as infile:
+            builder = _TreeBuilder(Document(skel.id), detach=True)
+            for part in iter_top_level_tags(_read_chunks(infile, chunk_size)):
+                finished = builder.feed(part)
+                if finished is not None:
+                    emit(finished)
+            finished = builder.close()
+            if finished is not None:
+                emit(finished)
+
+        foot = []
+        if footer is not None:
+            with _stage("footer"):
+                write_footer(footer, foot)
+        for m, write in writes.items():
+            write("</div>")
+            write(_page_scripts(m, urls[m]))
+            for fragment in foot:
+                write(fragment)
+            write('</div></body></html>')
+    finally:
+        for f in files.values():
+            f.close()
+    for path in outpaths.values():
+        _finish_output(path, precompress)
+
+def write_page(
+        doc: DocNode, 
+        outpath: str, 
+        mode='dark', 
+        title='Wbuild Page', 
+        favicon='', 
+        footer: Optional[DocNode]=None,
+        assets_dir: Optional[str]=None,
+        src_dir: Optional[str]=None,
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search_index: Optional[str]=None) -> None:
+    """
+    Write the page of `doc` to `outpath`, see `build_page`. `src_dir` and
+    `img_widths` are passed to `prepare_images`.
+    """
+    with _stage("images"):
+        prepare_images(doc, (item for item, _ in _walk(doc)), _page_dirs([outpath]), src_dir, img_widths)
+    outdir = os.path.dirname(outpath)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+    urls = asset_urls(assets_dir, os.path.dirname(os.path.abspath(outpath))) if assets_dir else None
+    critical_css = critical_css and urls is None
+    if _profile.get() is None and not minify and not critical_css:
+        with open(outpath, "w") as save_to:
+            write_html(doc, save_to, mode=mode, title=title, favicon=favicon, footer=footer, asset_urls=urls, 
+                search_index=search_index)
+        _finish_output(outpath, precompress)
+        return
+    # render to memory so that writing is timed separately
+    page = []
+    write_html(doc, page, mode=mode, title=title, favicon=favicon, footer=footer, asset_urls=urls, 
+        search_index=search_index)
+    if critical_css:
+        with _stage("css"):
+            page[0] = _critical_head(page, mode, footer is not None, title, favicon)
+    if minify:
+        with _stage("minify"):
+            page = minify_page(page)
+    with _stage("write"):
+        with open(outpath, "w") as save_to:
+            save_to.writelines(page)
+        _finish_output(outpath, precompress)
+
+# footer shared by the pages a site worker builds, whether to profile them,
+# where their assets are written, their srcset widths, output options (see
+# `build_page`) and whether they get a search box and shard, set by _init_site_worker
+_site_footer = None
+_site_profile = False
+_site_assets_dir = None
+_site_img_widths = ()
+_site_minify = False
+_site_precompress = False
+_site_critical_css = False
+_site_search = False
+
+def _init_site_worker(
+        footer: Optional[DocNode], 
+        assets: dict[str, str], 
+        profile: bool=False, 
+        assets_dir: Optional[str]=None,
+        img_widths: Iterable[int]=(),
+        image_cache: Optional[str]=None,
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search: bool=False,
+        asset_names: Optional[dict[str, str]]=None) -> None:
+    global _site_footer, _site_profile, _site_assets_dir, _site_img_widths
+    global _site_minify, _site_precompress, _site_critical_css, _site_search
+    _site_footer = footer
+    _site_profile = profile
+    _site_assets_dir = assets_dir
+    _site_img_widths = tuple(img_widths)
+    _site_minify = minify
+    _site_precompress = precompress
+    _site_critical_css = critical_css
+    _site_search = search
+    _assets.update(assets)
+    # names hashed by the parent, see `_asset_name`
+    for path, name in (asset_names or {}).items():
+        _asset_names[path] = (_assets[path], name)
+    use_image_cache(image_cache)
+
+def _build_site_page(
+        inpath: str, 
+        outpath: str, 
+        mode: str | list[str], 
+        title: str, 
+        favicon: str,
+        out_dir: Optional[str]=None) -> float | tuple[float, dict[str, Any]]:
+    """
+    Returns: build seconds, and the `Profile.to_dict` report if the worker profiles
+    """
+    search_index = search_shard = None
+    if _site_search:
+        rel = os.path.relpath(outpath, out_dir)
+        search_index = search_index_url(rel)
+        search_shard = search_shard_path(out_dir, rel)
+    if not _site_profile:
+        start = time.perf_counter()
+        build_page(inpath, outpath, mode, title, favicon, _site_footer, _site_assets_dir, out_dir, _site_img_widths, 
+            _site_minify, _site_precompress, _site_critical_css, search_index, search_shard)
+        save_image_cache()
+        return time.perf_counter() - start
+    with profiling() as prof:
+        start = time.perf_counter()
+        build_page(inpath, outpath, mode, title, favicon, _site_footer, _site_assets_dir, out_dir, _site_img_widths, 
+            _site_minify, _site_precompress, _site_critical_css, search_index, search_shard)
+        seconds = time.perf_counter() - start
+    save_image_cache()
+    return seconds, prof.to_dict()
+
+SEARCH_INDEX_FILE = "search-index.json"
+SEARCH_SHARD_DIR = ".wbuild-search"
+SEARCH_VERSION = 1
+_SEARCH_TOKEN = re.compile(r"\w{2,}")
+
+def _plain_text(ast: list) -> str:
+    # text a reader sees of an inline AST, without what \showarg and
+    # \tableofcontents insert from elsewhere
+    text = []
+    for node in ast:
+        if isinstance(node, str):
+            text.append(node)
+        elif node[0] == "link":
+            text.append(node[2] or node[1] or "")
+        elif node[0] in ("bold", "italic", "textcode"):
+            text.append(node[1] or "")
+    return " ".join(text)
+
+def _search_text(part: DocNode) -> str:
+    if part.type == "list":
+        return " ".join(_plain_text(ast) for _, ast in _inline_of(part, "data"))
+    if part.type in ("text", "img"):
+        return _plain_text(_inline_of(part, "data" if part.type == "text" else "caption"))
+    if part.type == "bq":
+        return part.data
+    return ""
+
+def search_entries(doc: DocNode) -> dict[str, Any]:
+    """
+    Search shard of `doc`: the words of its text, list, quote, header and
+    caption items by the heading they are under.
+    Returns: {'version', 'title' (first heading, or ''), 'sections': [[heading
+    id, heading]] ('' for the top of the page), 'tokens': {token: [section
+    indices]}}
+    """
+    title = ""
+    sections = [["", ""]]
+    tokens = {}
+    for part, _ in _walk(doc):
+        if part.type in _HEADING_LEVELS:
+            text = _plain_text(_inline_of(part, "label"))
+            title = title or text
+            sections.append([str(part.id), text])
+        else:
+            text = _search_text(part)
+        for token in set(_SEARCH_TOKEN.findall(text.lower())):
+            ids = tokens.setdefault(token, [])
+            if not ids or ids[-1] != len(sections) - 1:
+                ids.append(len(sections) - 1)
+    return {"version": SEARCH_VERSION, "title": title, "sections": sections, "tokens": tokens}
+
+def search_shard_path(out_dir: str, rel: str) -> str:
+    # shard of the page at `rel` in `out_dir`, written by `build_page`
+    return os.path.join(out_dir, SEARCH_SHARD_DIR, rel + ".json")
+
+def search_index_url(rel: str) -> str:
+    """
+    Returns: URL of the site's `SEARCH_INDEX_FILE` relative to the page at
+    `rel` (output path relative to the site's output directory, or to a
+    theme directory of it)
+    """
+    return posixpath.relpath(SEARCH_INDEX_FILE, posixpath.dirname(rel.replace(os.sep, "/")) or ".")
+
+def write_search_shard(doc: DocNode, path: str) -> None:
+    entries = search_entries(doc)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entries, f, separators=(",", ":"))
+    os.replace(tmp, path)
 
-        if (
-            (re.search(r"\\\w+\{$", before_match)  # Check if it's preceded by \word{ (without escape)
-            or re.search(r"\\\w+\{[^{}]*\}\{$", before_match))  # Check if it's part of \word{ignored}{ 
-            and after_match.startswith("}")):
-            i = cmd_end
+def merge_search_shards(out_dir: str, rels: Iterable[str]) -> dict[str, Any]:
+    """
+    Merge the search shards of the pages at `rels` (see `search_entries`)
+    into one index. Pages without a shard are left out.
+    Returns: {'version', 'pages': [[URL, title]], 'sections': [[page index,
+    heading id, heading]], 'tokens': {token: [section indices]}}, URLs are
+    relative to the index. Section indices are ascending and stored as the
+    difference to the previous one, to keep the index small
+    """
+    pages = []
+    sections = []
+    tokens = {}
+    for rel in rels:
+        try:
+            with open(search_shard_path(out_dir, rel)) as f:
+                shard = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if shard.get("version") != SEARCH_VERSION:
             continue
+        url = rel.replace(os.sep, "/")
+        page = len(pages)
+        pages.append([url, shard["title"] or posixpath.splitext(url)[0]])
+        offset = len(sections)
+        sections.extend([page, ident, heading] for ident, heading in shard["sections"])
+        for token, ids in shard["tokens"].items():
+            tokens.setdefault(token, []).extend(i + offset for i in ids)
+    tokens = {
+        token: [ids[0], *(cur - prev for prev, cur in zip(ids, ids[1:]))] 
+        for token, ids in sorted(tokens.items())
+    }
+    return {"version": SEARCH_VERSION, "pages": pages, "sections": sections, "tokens": tokens}
 
-        i = cmd_end
+def write_search_index(out_dir: str, rels: Iterable[str], index_dirs: Iterable[str], precompress: bool=False) -> None:
+    """
+    Write the index merged from the shards of the pages at `rels` (see
+    `merge_search_shards`) as `SEARCH_INDEX_FILE` in each of `index_dirs`.
+    An index is only written again if its contents changed.
+    """
+    index = json.dumps(merge_search_shards(out_dir, rels), separators=(",", ":"))
+    for index_dir in index_dirs:
+        path = os.path.join(index_dir, SEARCH_INDEX_FILE)
+        try:
+            with open(path) as f:
+                if f.read() == index and os.path.exists(path + ".gz") == precompress:
+                    continue
+        except OSError:
+            pass
+        os.makedirs(index_dir, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(index)
+        _finish_output(path, precompress)
+
+CACHE_FILE = ".wbuild-cache.json"
+CACHE_VERSION = 2
+
+def _file_hash(path: str) -> str:
+    import hashlib
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _build_key(footer_path: str, options: dict[str, Any]) -> str:
+    """
+    Returns: hash of everything a page's output depends on besides its own
+    source: this script, the assets, the footer and the build options
+    """
+    import hashlib
+    key = hashlib.sha256()
+    for path in [os.path.abspath(__file__), *_asset_paths()]:
+        key.update(_file_hash(path).encode())
+    key.update(_file_hash(footer_path).encode() if footer_path else b"-")
+    key.update(json.dumps(options, sort_keys=True).encode())
+    return key.hexdigest()
+
+def _load_cache(out_dir: str) -> dict[str, Any]:
+    try:
+        with open(os.path.join(out_dir, CACHE_FILE)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if cache.get("version") == CACHE_VERSION else {}
+
+def _save_cache(out_dir: str, key: str, pages: dict[str, dict[str, Any]]) -> None:
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, CACHE_FILE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": CACHE_VERSION, "key": key, "pages": pages}, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def _image_stats(paths: Iterable[str]) -> dict[str, list[int] | None]:
+    # stat keys of a page's local images, as stored in CACHE_FILE
+    stats = {}
+    for path in paths:
+        key = _stat_key(path)
+        stats[path] = list(key) if key is not None else None
+    return stats
+
+def _page_unchanged(entry: Optional[dict[str, Any]], src_hash: str) -> bool:
+    # whether a page's CACHE_FILE entry matches its source and images
+    return (entry is not None and entry["source"] == src_hash 
+        and _image_stats(entry["images"]) == entry["images"])
+
+def build_site(
+        src: str, 
+        out_dir: str, 
+        jobs: Optional[int]=None, 
+        mode='dark', 
+        title='Wbuild Page', 
+        favicon='', 
+        footer_path: str="",
+        force: bool=False,
+        rebuild: Iterable[str]=(),
+        profiles: Optional[dict[str, dict]]=None,
+        assets: Literal['inline', 'external']='inline',
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search: bool=False) -> list[tuple[str, float | Exception | None]]:
+    """
+    Build every page found by `find_pages(src)` into `out_dir`, in parallel
+    across `jobs` processes. The footer is parsed and the assets are read once,
+    then shared with the workers.
+
+    Source hashes of built pages are kept in `CACHE_FILE` in `out_dir`, along
+    with a key for the footer, assets and options and the mtime and size of
+    the local images each page references (their sizes are part of the
+    page). A page is skipped if none of these changed since it was last built.
+    Params:
+    - src: input directory or glob pattern
+    - out_dir: output directory, the input layout is kept
+    - jobs: number of processes, defaults to the number of cores. 1 builds
+    in this process
+    - mode: page theme, or list of themes to build each page in from one
+    parse, into a directory per theme in `out_dir` (see `theme_outpath`)
+    - title, favicon: see `write_html`
+    - footer_path: optional footer file path
+    - force: rebuild all pages, ignoring the cache
+    - rebuild: input paths of pages to rebuild even if unchanged
+    - profiles: if given, built pages are profiled and their reports
+    (see `Profile.to_dict`) stored by input path
+    - assets: 'inline' to include the style sheet and scripts in every page,
+    'external' to write them once to `out_dir` (see `write_assets`) and link them
+    - img_widths: srcset widths, see `prepare_images`. Image sizes and hashes
+    are kept in `IMAGE_CACHE_FILE` in `out_dir`
+    - minify, precompress, critical_css: see `build_page`, `precompress`
+    also applies to external assets
+    - search: give pages a search box and write the site's search index
+    (see `write_search_index`) to `out_dir`, or to each theme's directory.
+    Pages keep their part of it in `SEARCH_SHARD_DIR`, so only rebuilt
+    pages are indexed again
+    Returns: (input path, build seconds, the exception raised or None if
+    skipped) per page
+    """
+    pages = find_pages(src, exclude=[footer_path] if footer_path else [])
+    if not assets in ("inline", "external"):
+        raise ValueError(f"Unknown assets mode: {assets}")
+    img_widths = sorted(set(img_widths))
+    key = _build_key(footer_path, {
+        "mode": mode, "title": title, "favicon": favicon, "assets": assets, "img_widths": img_widths,
+        "minify": minify, "precompress": precompress, "critical_css": critical_css, "search": search,
+    })
+    cache = {} if force else _load_cache(out_dir)
+    cached = cache.get("pages", {}) if cache.get("key") == key else {}
+    hashes = {rel: _file_hash(inpath) for inpath, rel in pages}
+    rebuild = set(rebuild)
+    results = {
+        inpath: None for inpath, rel in pages
+        if _page_unchanged(cached.get(rel), hashes[rel])
+        and all(os.path.exists(path) for path in _page_outputs(os.path.join(out_dir, rel), mode, out_dir))
+        and (not search or os.path.exists(search_shard_path(out_dir, rel)))
+        and inpath not in rebuild
+    }
+    todo = [(inpath, rel) for inpath, rel in pages if not inpath in results]
+
+    assets_dir = out_dir if assets == "external" else None
+    if assets_dir is not None:
+        write_assets(assets_dir, precompress, search)
+    if todo:
+        _build_site_pages(todo, out_dir, jobs, mode, title, favicon, footer_path, results, profiles, assets_dir, 
+            img_widths, minify, precompress, critical_css, search)
+    if search:
+        index_dirs = [out_dir] if isinstance(mode, str) else [os.path.join(out_dir, m) for m in mode]
+        write_search_index(out_dir, [rel for _, rel in pages], index_dirs, precompress)
+
+    _save_cache(out_dir, key, {
+        rel: cached[rel] if results[inpath] is None else {
+            "source": hashes[rel], 
+            "images": _image_stats(_page_img_paths(inpath, os.path.join(out_dir, rel))),
+        }
+        for inpath, rel in pages if not isinstance(results[inpath], Exception)
+    })
+    return [(inpath, results[inpath]) for inpath, _ in pages]
+
+def _build_site_pages(
+        pages: list[tuple[str, str]], 
+        out_dir: str, 
+        jobs: Optional[int], 
+        mode: str | list[str], 
+        title: str, 
+        favicon: str, 
+        footer_path: str, 
+        results: dict[str, float | Exception | None],
+        profiles: Optional[dict[str, dict]]=None,
+        assets_dir: Optional[str]=None,
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search: bool=False) -> None:
+    """
+    Build `pages`, storing build seconds or the exception raised in `results`
+    and profile reports in `profiles` if given. Pages link the assets in
+    `assets_dir` if given.
+    """
+    image_cache = os.path.join(out_dir, IMAGE_CACHE_FILE)
+    footer = load_footer(footer_path) if footer_path else None
+    assets = {path: _read_asset(path) for path in _asset_paths()}
+    asset_names = {path: _asset_name(path) for path in assets} if assets_dir is not None else None
+    jobs = jobs or os.cpu_count() or 1
+    profile = profiles is not None
+
+    def store(inpath, res):
+        if profile:
+            res, profiles[inpath] = res
+        results[inpath] = res
+
+    if jobs == 1 or len(pages) < 2:
+        _init_site_worker(footer, assets, profile, assets_dir, img_widths, image_cache, minify, precompress, 
+            critical_css, search, asset_names)
+        for inpath, rel in pages:
+            try:
+                store(inpath, _build_site_page(
+                    inpath, os.path.join(out_dir, rel), mode, title, favicon, out_dir))
+            except Exception as e:
+                results[inpath] = e
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(
+                max_workers=min(jobs, len(pages)),
+                initializer=_init_site_worker, 
+                initargs=(footer, assets, profile, assets_dir, img_widths, image_cache, minify, precompress, 
+                    critical_css, search, asset_names)) as pool:
+            futures = {
+                pool.submit(_build_site_page, inpath, os.path.join(out_dir, rel), 
+                    mode, title, favicon, out_dir): inpath
+                for inpath, rel in pages
+            }
+            for future in as_completed(futures):
+                try:
+                    store(futures[future], future.result())
+                except Exception as e:
+                    results[futures[future]] = e
+
+def _print_site_summary(results: list[tuple[str, float | Exception | None]], wall: float, jobs: int, n_slowest: int=10) -> None:
+    failed = [(path, res) for path, res in results if isinstance(res, Exception)]
+    skipped = [path for path, res in results if res is None]
+    timed = sorted(
+        ((path, res) for path, res in results if isinstance(res, float)),
+        key=lambda item: item[1], reverse=True)
+    print(f"Built {len(timed)}/{len(results)} pages in {wall:.2f}s ({jobs} jobs)"
+        + (f", {len(skipped)} unchanged" if skipped else ""))
+    if timed:
+        print(f"Page time: total {sum(t for _, t in timed):.2f}s, "
+            + f"mean {sum(t for _, t in timed) / len(timed):.3f}s")
+        print("Slowest pages:")
+        for path, t in timed[:n_slowest]:
+            print(f"  {t:8.3f}s  {path}")
+    for path, err in failed:
+        print(f"Failed {path}: {type(err).__name__}: {err}")
+
+def _single_assets_dir(outpath: str) -> str:
+    # external assets of a single page go next to it
+    return os.path.dirname(os.path.abspath(outpath))
+
+def _is_site_src(src: str) -> bool:
+    return os.path.isdir(src) or any(c in src for c in "*?[")
+
+_URL_SCHEME = re.compile(r"^([a-zA-Z][a-zA-Z0-9+.-]*:|//)")
+
+def _page_img_paths(inpath: str, outpath: str) -> list[str]:
+    """
+    Local files referenced by `src` of [img] tags in the wbuild file `inpath`,
+    found by lexing only (no doc dict is built)
+    Params:
+    - inpath: wbuild code path
+    - outpath: page output path. `src` is relative to its directory, but
+    images are often kept next to the sources, so both are returned
+    Returns: list of image paths
+    """
+    try:
+        with open(inpath) as f:
+            text = f.read()
+    except OSError:
+        return []
+    bases = {os.path.dirname(os.path.abspath(outpath)), os.path.dirname(os.path.abspath(inpath))}
+    paths = []
+    last_img = False
+    for part in iter_top_level_tags(text):
+        if is_type_tag(part):
+            last_img = delete_leading_whitespace(part) == "[img]"
+            continue
+        if last_img and is_args(part):
+            src = parse_args(part).get("src", "")
+            if src and not _URL_SCHEME.match(src):
+                paths += [os.path.normpath(os.path.join(base, src)) for base in bases]
+        last_img = False
+    return paths
+
+def _stat_key(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
-        args = []
-        while i < length and text[i] == '{':  # Process arguments
-            arg_start = i + 1
-            arg_end = arg_start
-            depth = 1
-
-            while arg_end < length and depth > 0:
-                if text[arg_end] == "{" and (arg_end == 0 or text[arg_end - 1] != "\\"):
-                    depth += 1
-                elif text[arg_end] == "}" and (arg_end == 0 or text[arg_end - 1] != "\\"):
-                    depth -= 1
-                arg_end += 1
+def _poll_changes(stats: dict[str, tuple | None]) -> set[str]:
+    """
+    Stat every path in `stats`, updating it
+    Returns: paths whose mtime or size changed
+    """
+    changed = set()
+    for path, key in stats.items():
+        new_key = _stat_key(path)
+        if new_key != key:
+            stats[path] = new_key
+            changed.add(path)
+    return changed
+
+_LIVERELOAD_PATH = "/__wbuild_reload"
+_LIVERELOAD_JS = ("<script>(function(){let gen=null;setInterval(function(){"
+    + f"fetch('{_LIVERELOAD_PATH}').then(r=>r.text()).then(t=>{{"
+    + "if(gen!==null&&t!==gen)location.reload();gen=t;}).catch(()=>{});},500);})();</script>")
+
+def serve_livereload(directory: str, port: int, generation: Callable[[], int]) -> "ThreadingHTTPServer":
+    """
+    Serve `directory` on localhost from a background thread. HTML pages get
+    a script polling `_LIVERELOAD_PATH`, which reloads the page when
+    `generation()` changes.
+    Params:
+    - directory: directory to serve
+    - port: port to listen on, 0 picks a free one
+    - generation: returns the current build number
+    Returns: running server, stop it with `shutdown()`
+    """
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    class LiveReloadHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body: bytes, content_type: str) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.split("?")[0] == _LIVERELOAD_PATH:
+                self._send(str(generation()).encode(), "text/plain")
+                return
+            fpath = self.translate_path(self.path)
+            if os.path.isdir(fpath):
+                fpath = os.path.join(fpath, "index.html")
+            if fpath.endswith(".html") and os.path.isfile(fpath):
+                with open(fpath, "rb") as f:
+                    body = f.read()
+                body_end = body.rfind(b"</body>")
+                if body_end >= 0:
+                    body = body[:body_end] + _LIVERELOAD_JS.encode() + body[body_end:]
+                self._send(body, "text/html; charset=utf-8")
+                return
+            super().do_GET()
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), LiveReloadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class PageCache:
+    """
+    Rendered pages by ETag, dropping the least recently used ones when their
+    total size exceeds `max_bytes`. Safe to use from several threads.
+    """
+    def __init__(self, max_bytes: int=64 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag: str) -> bytes | None:
+        with self._lock:
+            body = self._pages.get(etag)
+            if body is not None:
+                self._pages.move_to_end(etag)
+            return body
+
+    def put(self, etag: str, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(etag, None)
+            if old is not None:
+                self.size -= len(old)
+            self._pages[etag] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, dropped = self._pages.popitem(last=False)
+                self.size -= len(dropped)
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    # If-None-Match check, weak comparison
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
 
-            if depth == 0:
-                arg = text[arg_start:arg_end - 1]  # Exclude outer braces
-                arg = arg.replace(r"\{", "{").replace(r"\}", "}")  # Unescape braces
-                args.append(arg)
-                i = arg_end  # Move past the closing brace
-
-        orig_text = text[cmd_start:i]  # Extract the full matched command
-
-        # Ensure that if there's only one argument but it's a full command, it stays in arg1
-        if len(args) == 1 and args[0].startswith("\\"):
-            args.append(None)  # Ensure arg2 is None
-
-        # Add extracted command to results
-        commands.append({
-            "cmd": cmd,
-            "arg1": args[0] if len(args) > 0 else None,
-            "arg2": args[1] if len(args) > 1 else None,
-            "string": orig_text
-        })
-    return commands
+def serve(
+        src: str,
+        port: int=8000,
+        mode='dark',
+        title='Wbuild Page',
+        favicon='',
+        footer_path: str="",
+        cache_bytes: int=64 << 20,
+        host: str="127.0.0.1") -> "ThreadingHTTPServer":
+    """
+    Serve the directory `src` on `host`, rendering a wbuild file `name.txt`
+    when `name.html` is requested (`index.txt` for a directory). Other files
+    are served as they are.
+
+    Rendered pages are kept in a `PageCache` under an ETag of the page's
+    path, source and build version (this script, assets, footer and
+    options), so a page is rendered again only once one of those changed.
+    Sources are only read again when their mtime or size changed, and
+    requests with a matching If-None-Match get a 304.
+    Params:
+    - src: directory of the sources
+    - port: port to listen on, 0 picks a free one
+    - mode, title, favicon, footer_path: see `build_site`
+    - cache_bytes: most bytes of rendered pages kept
+    - host: address to listen on
+    Returns: running server (serving from a background thread), stop it
+    with `shutdown()`
+    """
+    import hashlib
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    cache = PageCache(cache_bytes)
+    options = {"mode": mode, "title": title, "favicon": favicon}
+    shared = [os.path.abspath(__file__), *_asset_paths()] + ([footer_path] if footer_path else [])
+    # (stat keys of the shared files, build key, Builder), replaced when they change
+    state = [None, "", None]
+    # source path -> (stat key, source hash)
+    sources = {}
+    lock = threading.Lock()
+
+    def builder() -> tuple[str, Builder]:
+        stats = [_stat_key(path) for path in shared]
+        with lock:
+            if stats != state[0]:
+                for path in shared:
+                    _assets.pop(path, None)
+                footer = load_footer(footer_path) if footer_path else None
+                state[:] = [stats, _build_key(footer_path, options), Builder(mode, title, favicon, footer)]
+            return state[1], state[2]
+
+    def source(path: str) -> tuple[str, Optional[str]]:
+        # (source hash, text if it had to be read)
+        key = _stat_key(path)
+        with lock:
+            known = sources.get(path)
+        if known is not None and known[0] == key:
+            return known[1], None
+        with open(path) as f:
+            text = f.read()
+        digest = source_hash(text)
+        with lock:
+            sources[path] = (key, digest)
+        return digest, text
+
+    class RenderHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=src, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+        def _source_path(self) -> str | None:
+            fpath = self.translate_path(self.path)
+            if os.path.isdir(fpath):
+                fpath = os.path.join(fpath, "index.html")
+            if fpath.endswith(".html") and not os.path.isfile(fpath):
+                txt = fpath[:-len(".html")] + ".txt"
+                if os.path.isfile(txt):
+                    return txt
+            return None
+
+        def _render(self, head_only: bool) -> bool:
+            path = self._source_path()
+            if path is None:
+                return False
+            build_key, page_builder = builder()
+            digest, text = source(path)
+            rel = os.path.relpath(path, src).replace(os.sep, "/")
+            etag = '"' + hashlib.sha256(f"{build_key}:{rel}:{digest}".encode()).hexdigest()[:32] + '"'
+            if _etag_matches(self.headers.get("If-None-Match"), etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return True
+            body = cache.get(etag)
+            if body is None:
+                if text is None:
+                    with open(path) as f:
+                        text = f.read()
+                try:
+                    body = page_builder.build(text).encode()
+                except Exception as e:
+                    self.send_error(500, f"Failed to build {rel}: {type(e).__name__}: {e}")
+                    return True
+                cache.put(etag, body)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            if not head_only:
+                self.wfile.write(body)
+            return True
+
+        def do_GET(self):
+            if not self._render(False):
+                super().do_GET()
+
+        def do_HEAD(self):
+            if not self._render(True):
+                super().do_HEAD()
+
+    server = ThreadingHTTPServer((host, port), RenderHandler)
+    server.page_cache = cache
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def watch(
+        src: str, 
+        out: str, 
+        jobs: Optional[int]=None, 
+        mode='dark', 
+        title='Wbuild Page', 
+        favicon='', 
+        footer_path: str="", 
+        port: Optional[int]=None,
+        interval: float=0.3, 
+        debounce: float=0.2,
+        assets: Literal['inline', 'external']='inline',
+        img_widths: Iterable[int]=(),
+        minify: bool=False,
+        precompress: bool=False,
+        critical_css: bool=False,
+        search: bool=False) -> None:
+    """
+    Poll the sources of `src`'s outputs and rebuild the affected outputs when
+    they change, until interrupted. Sources are the page files, local images
+    they reference, the footer and the assets. A burst of changes is collected
+    until nothing changed for `debounce` seconds, then built at once.
+    Params:
+    - src: wbuild file, or input directory/glob for a site (see `build_site`)
+    - out: output file, or output directory for a site
+    - jobs, mode, title, favicon, footer_path: see `build_site`
+    - port: if given, serve the output with live reload (see `serve_livereload`)
+    - interval: seconds between polls
+    - debounce: quiet period before rebuilding
+    - assets, img_widths, minify, precompress, critical_css, search: see
+    `build_site`, `search` only applies to sites
+    """
+    site = _is_site_src(src)
+    shared = _asset_paths() + ([footer_path] if footer_path else [])
+    generation = 0
+    server = None
+    if port is not None:
+        serve_dir = out if site else os.path.dirname(os.path.abspath(out))
+        os.makedirs(serve_dir, exist_ok=True)
+        server = serve_livereload(serve_dir, port, lambda: generation)
+        print(f"Serving {serve_dir} at http://localhost:{server.server_address[1]}/")
+
+    def find():
+        if not site:
+            return {src: out}
+        return {
+            inpath: os.path.join(out, rel) 
+            for inpath, rel in find_pages(src, exclude=[footer_path] if footer_path else [])
+        }
+
+    pages = find()
+    imgs = {inpath: _page_img_paths(inpath, outpath) for inpath, outpath in pages.items()}
+
+    def dependents() -> dict[str, set[str] | None]:
+        # watched path -> inputs of pages to rebuild, None for all pages
+        deps = {path: None for path in shared}
+        for inpath in pages:
+            for path in [inpath, *imgs[inpath]]:
+                if deps.get(path, ()) is not None:
+                    deps.setdefault(path, set()).add(inpath)
+        return deps
+
+    deps = dependents()
+    stats = {path: _stat_key(path) for path in deps}
+    print(f"Watching {len(deps)} files, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(interval)
+            changed = _poll_changes(stats)
+            found = find() if site else pages
+            added = found.keys() - pages.keys()
+            if not changed and not added:
+                continue
+            while True:
+                time.sleep(debounce)
+                more = _poll_changes(stats)
+                if not more:
+                    break
+                changed |= more
+
+            pages = found
+            for path in changed:
+                _assets.pop(path, None)
+            if any(deps.get(path, ()) is None for path in changed):
+                targets = set(pages)
+            else:
+                targets = set(added)
+                for path in changed:
+                    targets |= deps.get(path, set())
+                targets &= pages.keys()
+            print(f"Changed: {', '.join(sorted(changed | added))}")
+            start = time.perf_counter()
+            if site:
+                results = build_site(src, out, jobs, mode, title, favicon, footer_path, rebuild=targets, assets=assets, 
+                    img_widths=img_widths, minify=minify, precompress=precompress, critical_css=critical_css, 
+                    search=search)
+                _print_site_summary(results, time.perf_counter() - start, jobs or os.cpu_count() or 1)
+            else:
+                try:
+                    footer = load_footer(footer_path) if footer_path else None
+                    assets_dir = _single_assets_dir(out) if assets == "external" else None
+                    if assets_dir is not None:
+                        write_assets(assets_dir, precompress)
+                    build_page(src, out, mode, title, favicon, footer, assets_dir, img_widths=img_widths, 
+                        minify=minify, precompress=precompress, critical_css=critical_css)
+                    save_image_cache()
+                    print(f"Built {out} in {time.perf_counter() - start:.2f}s")
+                except Exception as e:
+                    print(f"Failed {src}: {type(e).__name__}: {e}")
+            generation += 1
+
+            for inpath in targets:
+                imgs[inpath] = _page_img_paths(inpath, pages[inpath])
+            deps = dependents()
+            stats = {path: stats[path] if path in stats else _stat_key(path) for path in deps}
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
 
 if __name__ == "__main__":
+    import argparse
+
     path_to_file = f"{scr_dir}/syntax.txt"
     save_path = f"{scr_dir}/output.html"
     mode = "light"
     view_built_site = False
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-infile", "-in", "-i", type=str, default=path_to_file, help="Main file wbuild code")
-    parser.add_argument("-out", "-o", type=str, default=save_path, help="HTML output path")
+    parser.add_argument("-infile", "-in", "-i", type=str, default=None, 
+        help=f"Main file wbuild code, or a directory/glob of files to build as a site (default {path_to_file})")
+    parser.add_argument("-out", "-o", type=str, default=None, 
+        help=f"HTML output path, output directory when building a site (default {save_path})")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="Site build processes (default: number of cores)")
+    parser.add_argument("--force", action="store_true", help="Site builds: rebuild unchanged pages too")
+    parser.add_argument("--watch", action="store_true", help="Rebuild when the input, footer, assets or local images change")
+    parser.add_argument("--port", type=int, default=None, 
+        help="Watch mode: serve the output on localhost with live reload. Serve mode: port (default 8000)")
+    parser.add_argument("--serve", action="store_true", 
+        help="Serve the -infile directory on localhost, rendering name.txt when name.html is requested "
+            + "and caching rendered pages until their source, the footer or the assets change")
+    parser.add_argument("--cache-mb", type=int, default=64, help="Serve mode: memory for rendered pages in MB")
     parser.add_argument("--view", action="store_true", help="Open on compilation")
-    parser.add_argument("--mode", type=str, default='light', help='File theme [\'light\', \'dark\']')
+    parser.add_argument("--mode", type=str, default='light', 
+        help='File theme [\'light\', \'dark\'], or a comma separated list to build each from one parse, '
+            + 'into a directory per theme next to the output')
     parser.add_argument("--footer", "-f", type=str, help='Optional footer file path', default="")
     parser.add_argument("--title", "-t", type=str, default="Wbuild page", help='Optional page title (tab name)')
     parser.add_argument("--icon", type=str, default='', help='Page icon path')
+    parser.add_argument("--assets", type=str, choices=["inline", "external"], default="inline",
+        help="inline: include styles and scripts in every page, external: write them once "
+            + "next to the output under content-hashed names and link them")
+    parser.add_argument("--img-widths", type=str, default="", metavar="W1,W2,...", 
+        help="Write downscaled copies of local [img] images at these widths next to them and list them "
+            + "in srcset (needs Pillow)")
+    parser.add_argument("--minify", action="store_true", 
+        help="Drop empty attributes and comments, collapse whitespace outside <pre> and move repeated inline "
+            + "styles into classes")
+    parser.add_argument("--precompress", action="store_true", 
+        help="Also write a .gz copy of every page (and external asset) for servers that send precompressed files")
+    parser.add_argument("--critical-css", action="store_true", 
+        help="Inline only the style rules each page may use (inline assets only, not with --stream)")
+    parser.add_argument("--search", action="store_true", 
+        help=f"Site builds: add a search box to every page and write a search index ({SEARCH_INDEX_FILE})")
+    parser.add_argument("--emit-tree", type=str, default=None, metavar="FILE", 
+        help="Also save the parsed document tree to FILE, for --from-tree")
+    parser.add_argument("--from-tree", type=str, default=None, metavar="FILE", 
+        help="Render the document tree saved in FILE instead of parsing the input. If -infile is given, "
+            + "FILE is only used if it was built from it, and rebuilt otherwise")
+    parser.add_argument("--stream", action="store_true", 
+        help="Read the input in chunks and write each top-level section as soon as it is complete, "
+            + "so memory is bounded by the largest section (slower: the input is read twice)")
+    parser.add_argument("--profile", type=str, nargs="?", const="-", default=None, metavar="FILE",
+        help="Print time and peak memory per build stage, render time per item type and search counts, "
+            + "or write them as JSON to FILE")
     args = parser.parse_args()
 
-    path_to_file = args.infile
-    save_path = args.out
-    mode = args.mode
+    path_to_file = args.infile if args.infile is not None else path_to_file
+    mode = list(dict.fromkeys(m.strip() for m in args.mode.split(",") if m.strip()))
+    if not mode:
+        parser.error("--mode needs at least one theme")
+    mode = mode[0] if len(mode) == 1 else mode
+    try:
+        img_widths = [int(w) for w in args.img_widths.split(",") if w.strip()]
+    except ValueError:
+        parser.error(f"Invalid --img-widths: {args.img_widths}")
+    if any(w <= 0 for w in img_widths):
+        parser.error(f"Invalid --img-widths: {args.img_widths}")
     view_built_site = args.view
 
-    sample_txt = open(path_to_file, "r").read()
-    save_to = open(save_path, "w")
-    doc = build_doc_dict(sample_txt)
-    html = html_from_dict(doc, mode=mode, footer_cmp_mode=(args.footer != ""), title=args.title, favicon=args.icon)
-    if args.footer != "":
-        html = create_and_append_footer(args.footer, html)
-    # soup = BeautifulSoup(html, 'html.parser')
-    # html = str(soup.prettify('utf-8'), 'utf-8');
-    save_to.write(html)
-    if view_built_site:
-        os.system(f"open '{save_path}'")
\ No newline at end of file
+    if args.serve:
+        if not os.path.isdir(path_to_file):
+            parser.error("--serve needs a directory as -infile")
+        if not isinstance(mode, str):
+            parser.error("--serve renders a single theme")
+        if args.search:
+            parser.error("--search needs a site build, pages are not indexed when served")
+        server = serve(path_to_file, args.port if args.port is not None else 8000, mode, args.title, args.icon, 
+            args.footer, args.cache_mb << 20)
+        print(f"Serving {path_to_file} at http://localhost:{server.server_address[1]}/, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        sys.exit(0)
+
+    if _is_site_src(path_to_file):
+        if args.emit_tree is not None or args.from_tree is not None or args.stream:
+            parser.error("--emit-tree, --from-tree and --stream build a single page")
+        out_dir = args.out if args.out is not None else os.path.splitext(save_path)[0]
+        jobs = args.jobs or os.cpu_count() or 1
+        start = time.perf_counter()
+        profiles = {} if args.profile is not None else None
+        results = build_site(path_to_file, out_dir, jobs, mode, args.title, args.icon, args.footer, args.force, 
+            profiles=profiles, assets=args.assets, img_widths=img_widths, minify=args.minify, 
+            precompress=args.precompress, critical_css=args.critical_css, search=args.search)
+        _print_site_summary(results, time.perf_counter() - start, jobs)
+        if args.profile == "-":
+            slowest = sorted(profiles.items(), key=lambda item: item[1]["seconds"], reverse=True)
+            for inpath, report in slowest[:10]:
+                print(format_profile(report, inpath))
+        elif args.profile is not None:
+            with open(args.profile, "w") as f:
+                json.dump(profiles, f, indent=1)
+        if args.watch:
+            watch(path_to_file, out_dir, jobs, mode, args.title, args.icon, args.footer, args.port, 
+                assets=args.assets, img_widths=img_widths, minify=args.minify, precompress=args.precompress, 
+                critical_css=args.critical_css, search=args.search)
+        sys.exit(1 if any(isinstance(res, Exception) for _, res in results) else 0)
+
+    save_path = args.out if args.out is not None else save_path
+    if args.search:
+        parser.error("--search indexes a site, pass a directory or glob as -infile")
+    if args.stream and (args.emit_tree is not None or args.from_tree is not None):
+        parser.error("--stream does not build a document tree, it can't be used with --emit-tree or --from-tree")
+    if args.stream and args.critical_css:
+        parser.error("--stream writes the style sheet before the page is rendered, it can't be used with --critical-css")
+    use_image_cache(os.path.join(os.path.dirname(os.path.abspath(save_path)), IMAGE_CACHE_FILE))
+    with profiling() if args.profile is not None else contextlib.nullcontext() as prof:
+        footer = None
+        if args.footer != "":
+            with _stage("footer"):
+                footer = load_footer(args.footer)
+        assets_dir = _single_assets_dir(save_path) if args.assets == "external" else None
+        if assets_dir is not None:
+            write_assets(assets_dir, args.precompress)
+        if args.stream:
+            stream_page(path_to_file, save_path, mode=mode, title=args.title, favicon=args.icon, footer=footer, 
+                assets_dir=assets_dir, img_widths=img_widths, minify=args.minify, precompress=args.precompress)
+        else:
+            doc = None
+            src_hash = ""
+            if args.from_tree is None or args.infile is not None:
+                with _stage("read"), open(path_to_file, "r") as infile:
+                    sample_txt = infile.read()
+                if args.from_tree is not None or args.emit_tree is not None:
+                    src_hash = source_hash(sample_txt)
+            if args.from_tree is not None:
+                try:
+                    doc = load_tree(args.from_tree, src_hash if args.infile is not None else None)
+                except (OSError, ValueError) as e:
+                    if args.infile is None:
+                        parser.error(str(e))
+                    print(f"Rebuilding {args.from_tree}: {e}")
+            if doc is None:
+                doc = build_doc_dict(sample_txt)
+                if args.from_tree is not None:
+                    save_tree(doc, args.from_tree, src_hash)
+            if args.emit_tree is not None:
+                save_tree(doc, args.emit_tree, src_hash)
+            parsed = args.from_tree is None or args.infile is not None
+            src_dir = os.path.dirname(os.path.abspath(path_to_file)) if parsed else None
+            if isinstance(mode, str):
+                write_page(doc, save_path, mode=mode, title=args.title, favicon=args.icon, footer=footer, 
+                    assets_dir=assets_dir, src_dir=src_dir, img_widths=img_widths, minify=args.minify, 
+                    precompress=args.precompress, critical_css=args.critical_css)
+            else:
+                write_pages(doc, {m: theme_outpath(save_path, m) for m in mode}, title=args.title, 
+                    favicon=args.icon, footer=footer, assets_dir=assets_dir, src_dir=src_dir, img_widths=img_widths, 
+                    minify=args.minify, precompress=args.precompress, critical_css=args.critical_css)
+    save_image_cache()
+    if args.profile == "-":
+        print(format_profile(prof.to_dict(), path_to_file if args.from_tree is None else args.from_tree))
+    elif args.profile is not None:
+        with open(args.profile, "w") as f:
+            json.dump(prof.to_dict(), f, indent=1)
+    if view_built_site and not (args.watch and args.port is not None):
+        os.system(f"open '{_page_outputs(save_path, mode)[0]}'")
+    if args.watch:
+        if view_built_site and args.port is not None:
+            page_url = os.path.relpath(_page_outputs(save_path, mode)[0], os.path.dirname(save_path))
+            os.system(f"open 'http://localhost:{args.port}/{page_url.replace(os.sep, '/')}'")
+        watch(path_to_file, save_path, None, mode, args.title, args.icon, args.footer, args.port, 
+            assets=args.assets, img_widths=img_widths, minify=args.minify, precompress=args.precompress, 
+            critical_css=args.critical_css)
\ No newline at end of file